@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+"""Offline micro-benchmarks of the hot path, no reddit required.
+python3 benchmark.py
+"""
+
+import itertools
+import os.path
+import random
+import string
+import time
+
+from cardDB import CardDB
+from constants import Constants
+from helper import HSHelper
+
+
+class NorvigSpellChecker():
+    """previous distance 1 spell checker for comparison
+    based on Peter Norvig
+    https://norvig.com/spell-correct.html
+    """
+    def __init__(self, names):
+        self.model = set(name.lower() for name in names)
+
+    def __known(self, words):
+        for w in words:
+            if w in self.model:
+                return w
+        return None
+
+    def __edits(self, word):
+        splits     = [(word[:i], word[i:]) for i in range(len(word) + 1)]
+        deletes    = (a + b[1:] for a, b in splits if b)
+        transposes = (a + b[1] + b[0] + b[2:] for a, b in splits if len(b)>1)
+        replaces   = (a + c + b[1:] for a, b in splits for c in string.ascii_lowercase if b)
+        inserts    = (a + c + b     for a, b in splits for c in string.ascii_lowercase)
+        return itertools.chain(deletes, transposes, replaces, inserts)
+
+    def correct(self, word):
+        lword = word.lower()
+        return self.__known([lword]) or self.__known(self.__edits(lword)) or word
+
+
+def typo(word, count, rnd):
+    """random deletes, replaces and inserts"""
+    for _ in range(count):
+        i = rnd.randrange(len(word))
+        c = rnd.choice(string.ascii_lowercase)
+        word = rnd.choice((word[:i] + word[i + 1:],
+                           word[:i] + c + word[i + 1:],
+                           word[:i] + c + word[i:]))
+    return word
+
+
+def timeLookups(checker, words, repeat=3):
+    """best per lookup time in microseconds"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for word in words:
+            checker.correct(word)
+        took = (time.perf_counter() - start) / len(words) * 1e6
+        best = took if best is None else min(best, took)
+    return best
+
+
+def benchSpelling(helper, samples=2000):
+    rnd = random.Random(42)
+    names = sorted(helper.spellChecker.model)
+    words = [rnd.choice(names) for _ in range(samples)]
+
+    cases = {
+        'exact': words,
+        'distance 1': [typo(w, 1, rnd) for w in words],
+        'distance 2': [typo(w, 2, rnd) for w in words],
+        'unknown': [''.join(rnd.choice(string.ascii_lowercase)
+                for _ in range(len(w))) for w in words]
+    }
+
+    start = time.perf_counter()
+    norvig = NorvigSpellChecker(names)
+    print('index build: norvig {:.0f} ms'.format(
+            (time.perf_counter() - start) * 1e3), end=', ')
+    start = time.perf_counter()
+    checker = type(helper.spellChecker)(names)
+    print('symspell {:.0f} ms'.format((time.perf_counter() - start) * 1e3))
+
+    print('{:<12} {:>14} {:>14}'.format('lookup', 'norvig us', 'symspell us'))
+    for name, case in cases.items():
+        print('{:<12} {:>14.1f} {:>14.1f}'.format(name,
+                timeLookups(norvig, case),
+                timeLookups(checker, case)))
+
+
+def benchCardRules(rawJson='raw-cards.json'):
+    """seconds per filter and field rule of the scrape, needs raw-cards.json"""
+    if not os.path.isfile(rawJson):
+        print('card rules: {} missing, run scrape.py once'.format(rawJson))
+        return
+
+    import scrape
+    with open(rawJson, encoding='utf8') as f:
+        cards = [card for card in scrape.iterJsonArray(f) if scrape.knownSet(card)]
+
+    timings = {}
+    scrape.applyCardRules(cards, timings)
+    print('{:<28} {:>10} ({} cards)'.format('card rule', 'ms', len(cards)))
+    for name, seconds in timings.items():
+        print('{:<28} {:>10.2f}'.format(name, seconds * 1e3))
+
+
+def main():
+    constants = Constants()
+    cardDB = CardDB(constants=constants, snapshotFile='data/cards.snapshot')
+    helper = HSHelper(cardDB, constants)
+
+    benchSpelling(helper)
+    benchCardRules()
+
+
+if __name__ == "__main__":
+    main()
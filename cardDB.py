@@ -1,16 +1,107 @@
 
+import collections
+import collections.abc
 import logging as log
-import itertools
+import hashlib
 import json
+import mmap
 import os
+import pickle
 import string
+import struct
+import sys
+import threading
 import time
+import types
 
 import requests
 
 import formatter
 
 
+# increase when the snapshot layout changes
+SNAPSHOT_VERSION = 3
+# magic, version, header size; followed by header and text blob
+_SNAPSHOT_HEAD = struct.Struct('<8sIQ')
+_SNAPSHOT_MAGIC = b'HSCARDS\0'
+
+
+def _digest(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def _cardDigest(card):
+    """short hash of a card to find changed cards"""
+    data = json.dumps(card, sort_keys=True).encode('utf8')
+    return hashlib.sha1(data).digest()[:8]
+
+
+class _TextStore(collections.abc.Mapping):
+    """read only card texts in a mapped snapshot, decoded on access"""
+
+    def __init__(self, blob, start, index):
+        self.__blob = blob
+        self.__start = start
+        self.__index = index
+
+    def __getitem__(self, key):
+        offset, length = self.__index[key]
+        offset += self.__start
+        return self.__blob[offset:offset + length].decode('utf8')
+
+    def __contains__(self, key):
+        return key in self.__index
+
+    def __iter__(self):
+        return iter(self.__index)
+
+    def __len__(self):
+        return len(self.__index)
+
+
+class _CardView(collections.abc.Mapping):
+    """One read only generation of the cards.
+    Temp cards hide changed card file cards which hide the base cards,
+    removed card file cards are None in the changes.
+    """
+
+    def __init__(self, generation, temp, changes, base):
+        self.generation = generation
+        self.temp = types.MappingProxyType(temp)
+        self.changes = types.MappingProxyType(changes)
+        self.base = base
+
+    def __getitem__(self, key):
+        if key in self.temp:
+            return self.temp[key]
+        if key in self.changes:
+            text = self.changes[key]
+            if text is None:
+                raise KeyError(key)
+            return text
+        return self.base[key]
+
+    def __contains__(self, key):
+        if key in self.temp:
+            return True
+        if key in self.changes:
+            return self.changes[key] is not None
+        return key in self.base
+
+    def __iter__(self):
+        yield from self.temp
+        for key, text in self.changes.items():
+            if text is not None and key not in self.temp:
+                yield key
+        for key in self.base:
+            if key not in self.temp and key not in self.changes:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
 class CardDB:
     """Wrapper around a PRAW reddit instance."""
     DUELS_CMD = 'd!'
@@ -23,12 +114,17 @@ class CardDB:
             vanillaJSON='data/vanilla.json',
             tokenJSON='data/tokens.json',
             tempJSON='data/tempinfo.json',
-            tempJSONUrl=None):
+            tempJSONUrl=None,
+            tempJSONTimeout=10,
+            snapshotFile=None):
         """Initialize an instance of CardDB.
 
         :param cardJSON: file containing cards
         :param tokenJSON: file containing tokens
         :param tempJSON: optional file containing more cards
+        :param tempJSONUrl: optional online file containing more cards
+        :param tempJSONTimeout: seconds to wait for the online file
+        :param snapshotFile: optional precompiled cards, see saveSnapshot()
         """
         self.constants = constants
         self.cardJSON = cardJSON
@@ -37,10 +133,20 @@ class CardDB:
         self.tokenJSON = tokenJSON
         self.tempJSON = tempJSON
         self.tempJSONUrl = tempJSONUrl
+        self.tempJSONTimeout = tempJSONTimeout
+        self.snapshotFile = snapshotFile
 
         self.tokens = []
 
-        self.__db = {}
+        # readers use the current view, refreshs publish a new one
+        self.__db = _CardView(0, {}, {}, {})
+        self.__publishLock = threading.Lock()
+        # card file to mtime and card hashes, to find changes
+        self.__fileDates = {}
+        self.__hashes = {}
+        # unix time of the last successful online check
+        self.lastRefresh = 0
+        self.__refreshThread = None
         self.__tempDate = 0
         self.__nextUrlRefresh = 0
         self.__etag = None
@@ -49,81 +155,265 @@ class CardDB:
 
     def __load(self):
 
-        # load cards
-        with open(self.cardJSON, 'r', encoding='utf8') as file:
+        for path, _ in self.__cardFiles():
+            self.__fileDates[path] = os.path.getmtime(path)
+
+        base = self.__loadSnapshot()
+        if base is None:
+            db, self.tokens, self.__hashes = self.__loadJSON()
+            base = types.MappingProxyType(db)
+
+        self.__db = _CardView(0, {}, {}, base)
+
+        # finally load temp file
+        self.refreshTemp()
+
+
+    def __cardFiles(self):
+        """card files and the prefix of their cards"""
+        return [(self.cardJSON, ''),
+                (self.tokenJSON, ''),
+                # duels and vanilla cards with command prefix
+                (self.duelsJSON, self.DUELS_CMD),
+                (self.vanillaJSON, self.VANILLA_CMD)]
+
+
+    def __readCards(self, path, prefix):
+        """json file to dict of clean name to card"""
+        with open(path, 'r', encoding='utf8') as file:
             cards = json.load(file)
-        with open(self.tokenJSON, 'r', encoding='utf8') as file:
-            tokens = json.load(file)
 
-        # json to db full of text
-        for name, card in itertools.chain(cards.items(), tokens.items()):
-            clean = CardDB.cleanName(name)
-            if clean in self.__db:
+        result = {}
+        for name, card in cards.items():
+            clean = prefix + CardDB.cleanName(name)
+            if clean in result:
                 log.error("load() duplicate name, already in the db: %s",
                         clean)
                 raise Exception('duplicate card: ' + clean)
+            result[clean] = card
 
-            self.__db[clean] = formatter.createCardText(card, self.constants)
+        return result
 
-        self.tokens = [CardDB.cleanName(name) for name in tokens.keys()]
 
-        # add duels cards as with command prefix
-        with open(self.duelsJSON, 'r', encoding='utf8') as file:
-            duels = json.load(file)
+    def __loadJSON(self):
+        """parse all card files and render the card texts"""
+        db = {}
+        tokenNames = []
+        hashes = {}
 
-        for name, card in duels.items():
-            clean = self.DUELS_CMD + CardDB.cleanName(name)
-            if clean in self.__db:
-                log.error("load() duplicate name, already in the db: %s", clean)
-                raise Exception('duplicate card: ' + clean)
+        for path, prefix in self.__cardFiles():
+            cards = self.__readCards(path, prefix)
+            hashes[path] = {}
 
-            self.__db[clean] = formatter.createCardText(card, self.constants)
+            # json to db full of text
+            for clean, card in cards.items():
+                if clean in db:
+                    log.error("load() duplicate name, already in the db: %s",
+                            clean)
+                    raise Exception('duplicate card: ' + clean)
 
-        # add vanilla cards as with command prefix
-        with open(self.vanillaJSON, 'r', encoding='utf8') as file:
-            duels = json.load(file)
+                db[clean] = formatter.createCardText(card, self.constants)
+                hashes[path][clean] = _cardDigest(card)
 
-        for name, card in duels.items():
-            clean = self.VANILLA_CMD + CardDB.cleanName(name)
-            if clean in self.__db:
-                log.error("load() duplicate name, already in the db: %s", clean)
-                raise Exception('duplicate card: ' + clean)
+            if path == self.tokenJSON:
+                tokenNames = list(cards.keys())
 
-            self.__db[clean] = formatter.createCardText(card, self.constants)
+        return db, tokenNames, hashes
 
-        # finally load temp file
+
+    def __sources(self):
+        """all files the rendered card texts depend on"""
+        return [self.cardJSON, self.tokenJSON, self.duelsJSON,
+                self.vanillaJSON, self.constants.constantJSON,
+                formatter.__file__]
+
+
+    def __loadSnapshot(self):
+        """map precompiled cards, None if missing or stale"""
+        if not self.snapshotFile or not os.path.isfile(self.snapshotFile):
+            return None
+
+        try:
+            with open(self.snapshotFile, 'rb') as file:
+                magic, version, headerSize = _SNAPSHOT_HEAD.unpack(
+                        file.read(_SNAPSHOT_HEAD.size))
+
+                if magic != _SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+                    log.info("loadSnapshot() old version, using json files")
+                    return None
+
+                header = pickle.loads(file.read(headerSize))
+
+                sources = header['sources']
+                if [path for path, *_ in sources] != self.__sources():
+                    log.info("loadSnapshot() other sources, using json files")
+                    return None
+
+                for path, size, mtime, digest in sources:
+                    stat = os.stat(path)
+                    # unchanged mtime is enough, a git checkout touches it
+                    if (stat.st_size, stat.st_mtime) != (size, mtime) \
+                            and _digest(path) != digest:
+                        log.info("loadSnapshot() %s changed, using json files",
+                                path)
+                        return None
+
+                # texts stay in the shared page cache until requested
+                blob = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            store = _TextStore(blob, _SNAPSHOT_HEAD.size + headerSize,
+                    header['index'])
+            self.tokens = header['tokens']
+            self.__hashes = header['hashes']
+            log.debug("loadSnapshot() mapped %s cards", len(store))
+            return store
+
+        except Exception as e:
+            log.warning("loadSnapshot() failed: %s", e)
+            return None
+
+
+    def saveSnapshot(self, snapshotFile=None):
+        """Compile card files, tokens and duels/vanilla cards into one
+        snapshot file. Temp cards are never part of the snapshot.
+
+        :param snapshotFile: target file (default: self.snapshotFile)
+        """
+        snapshotFile = snapshotFile or self.snapshotFile
+        db, tokens, hashes = self.__loadJSON()
+
+        sources = []
+        for path in self.__sources():
+            stat = os.stat(path)
+            sources.append((path, stat.st_size, stat.st_mtime, _digest(path)))
+
+        # all texts in one utf8 blob, the index points into it
+        blob = bytearray()
+        index = {}
+        for clean, text in db.items():
+            data = text.encode('utf8')
+            index[clean] = (len(blob), len(data))
+            blob += data
+
+        header = pickle.dumps({
+            'sources': sources,
+            'tokens': tokens,
+            'hashes': hashes,
+            'index': index
+        }, protocol=pickle.HIGHEST_PROTOCOL)
+
+        # replace, never leave a half written file for the bot
+        tmpFile = snapshotFile + '.tmp'
+        with open(tmpFile, 'wb') as file:
+            file.write(_SNAPSHOT_HEAD.pack(_SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                    len(header)))
+            file.write(header)
+            file.write(blob)
+        os.replace(tmpFile, snapshotFile)
+
+        log.debug("saveSnapshot() saved %s cards to %s", len(db), snapshotFile)
+
+
+    def refresh(self):
+        """Reload changed card files and temp cards."""
+        self.refreshFiles()
         self.refreshTemp()
 
 
+    def refreshFiles(self):
+        """Reload changed card files, only changed cards are rendered again.
+        This includes duels and vanilla cards, which were only read on
+        start before. Changes of constants or formatter still require a restart.
+        """
+        # read all changed files first, cards may move between files
+        changed = {}
+        for path, prefix in self.__cardFiles():
+            try:
+                currentDate = os.path.getmtime(path)
+            except OSError:
+                continue
+
+            if currentDate == self.__fileDates.get(path):
+                continue
+
+            try:
+                cards = self.__readCards(path, prefix)
+            except Exception as e:
+                # maybe half written, the next refresh tries again
+                log.error("refreshFiles() failed %s: %s", path, e)
+                continue
+
+            changed[path] = (currentDate, cards)
+
+        # a file with duplicates of the new contents of others keeps its old cards
+        while True:
+            owners = {}
+            for path, hashes in self.__hashes.items():
+                if path not in changed:
+                    owners.update(dict.fromkeys(hashes, path))
+            for path, (_, cards) in changed.items():
+                for clean in cards:
+                    owners.setdefault(clean, path)
+
+            duplicates = [path for path, (_, cards) in changed.items()
+                    if any(owners[clean] != path for clean in cards)]
+            if not duplicates:
+                break
+            for path in duplicates:
+                log.error("refreshFiles() failed %s: duplicate cards", path)
+                del changed[path]
+
+        if not changed:
+            return
+
+        # removals first, a moved card is added again by its new file
+        removed = {}
+        added = {}
+        newHashes = {}
+        for path, (_, cards) in changed.items():
+            oldHashes = self.__hashes.get(path, {})
+            hashes = newHashes[path] = {}
+            count = 0
+
+            for clean, card in cards.items():
+                hashes[clean] = _cardDigest(card)
+                if hashes[clean] != oldHashes.get(clean):
+                    added[clean] = formatter.createCardText(card, self.constants)
+                    count += 1
+
+            for clean in oldHashes.keys() - hashes.keys():
+                removed[clean] = None
+                count += 1
+
+            log.info("refreshFiles() %s changed cards in %s", count, path)
+
+        removed.update(added)
+        if removed:
+            self.__publish(changes=removed)
+
+        for path, (currentDate, cards) in changed.items():
+            self.__hashes[path] = newHashes[path]
+            self.__fileDates[path] = currentDate
+            if path == self.tokenJSON:
+                self.tokens = list(cards.keys())
+
+
     def refreshTemp(self):
-        """Reload cards from tempJSON and overwrite existing."""
+        """Reload cards from tempJSON and overwrite existing.
+        The online file is loaded in a background thread.
+        """
         if self.tempJSONUrl:
             # online file
             # throttle to check every ten minutes
-            if time.time() < self.__nextUrlRefresh:
-                return
-            self.__nextUrlRefresh = time.time() + (10 * 60)
-
-            try:
-                headers = {}
-                if self.__etag:
-                    headers = { 'If-None-Match' : self.__etag }
-
-                res = requests.get(self.tempJSONUrl, headers=headers)
-
-                if res.status_code == 200:
-                    log.debug("refreshTemp() online: 200, refreshing")
-                    self.__etag = res.headers.get("etag")
-                    for name, card in res.json().items():
-                        clean = CardDB.cleanName(name)
-                        self.__db[clean] = formatter.createCardText(card,
-                            self.constants)
-
-                if res.status_code == 304:
-                    log.debug("refreshTemp() online: 304 no changes")
-                    return
-            except Exception as e:
-                log.debug("refreshTemp() failed online: %s", e)
+            if time.time() >= self.__nextUrlRefresh \
+                    and not (self.__refreshThread
+                            and self.__refreshThread.is_alive()):
+                self.__nextUrlRefresh = time.time() + (10 * 60)
+                self.__refreshThread = threading.Thread(
+                        target=self.__refreshOnline,
+                        name='refreshTemp',
+                        daemon=True)
+                self.__refreshThread.start()
 
         # offline file
         if not os.path.isfile(self.tempJSON):
@@ -137,15 +427,81 @@ class CardDB:
         self.__tempDate = currentDate
 
         try:
+            rendered = {}
             with open(self.tempJSON, 'r', encoding='utf8') as file:
                 for name, card in json.load(file).items():
                     clean = CardDB.cleanName(name)
-                    self.__db[clean] = formatter.createCardText(card,
+                    rendered[clean] = formatter.createCardText(card,
                         self.constants)
+            self.__publish(temp=rendered)
         except Exception as e:
             log.debug("refreshTemp() failed: %s", e)
 
 
+    def __refreshOnline(self):
+        """fetch, parse and render online cards, then add them at once"""
+        try:
+            headers = {}
+            if self.__etag:
+                headers = { 'If-None-Match' : self.__etag }
+
+            res = requests.get(self.tempJSONUrl, headers=headers,
+                    timeout=self.tempJSONTimeout)
+
+            if res.status_code == 200:
+                log.debug("refreshTemp() online: 200, refreshing")
+                rendered = {}
+                for name, card in res.json().items():
+                    clean = CardDB.cleanName(name)
+                    rendered[clean] = formatter.createCardText(card,
+                        self.constants)
+
+                self.__publish(temp=rendered)
+                self.__etag = res.headers.get("etag")
+                self.lastRefresh = time.time()
+
+            elif res.status_code == 304:
+                log.debug("refreshTemp() online: 304 no changes")
+                self.lastRefresh = time.time()
+
+            else:
+                log.debug("refreshTemp() online: %s", res.status_code)
+
+        except Exception as e:
+            log.debug("refreshTemp() failed online: %s", e)
+
+
+    def __publish(self, *, temp=None, changes=None):
+        """copy the changed layers, add new cards and swap in a new view"""
+        with self.__publishLock:
+            db = self.__db
+            newTemp = dict(db.temp)
+            newTemp.update(temp or {})
+            newChanges = dict(db.changes)
+            newChanges.update(changes or {})
+            self.__db = _CardView(db.generation + 1, newTemp, newChanges,
+                    db.base)
+
+
+    @property
+    def generation(self):
+        """increased on every change of the cards"""
+        return self.__db.generation
+
+
+    def waitForRefresh(self, timeout=None):
+        """block until a running online refresh is done"""
+        if self.__refreshThread:
+            self.__refreshThread.join(timeout)
+
+
+    def lastRefreshAge(self):
+        """seconds since the online file was checked successfully or None"""
+        if not self.lastRefresh:
+            return None
+        return time.time() - self.lastRefresh
+
+
     def cleanName(name):
         """ignore all special characters, numbers, whitespace, case"""
         return ''.join(c for c in name.lower() if c in string.ascii_lowercase)
@@ -166,24 +522,37 @@ class CardDB:
 
 
     def __contains__(self, item):
+        db = self.__db
         # direct hit or duels hit
-        return item in self.__db \
-                or (self.DUELS_CMD + item) in self.__db \
-                or (self.VANILLA_CMD + item) in self.__db
+        return item in db \
+                or (self.DUELS_CMD + item) in db \
+                or (self.VANILLA_CMD + item) in db
 
     def __getitem__(self, key):
+        db = self.__db
         try:
             # get direct hit first (might be with hd!)
-            return self.__db[key]
+            return db[key]
         except Exception as e:
             # try vanilla as fallback
-            card = self.__db.get(self.VANILLA_CMD + key)
+            card = db.get(self.VANILLA_CMD + key)
             if card:
                 return card
             # try duels as fallback
-            card = self.__db.get(self.DUELS_CMD + key)
+            card = db.get(self.DUELS_CMD + key)
             if card:
                 return card
             # raise original key error
             raise e
 
+
+
+if __name__ == "__main__":
+    # build step: python3 cardDB.py [snapshotFile]
+    from constants import Constants
+
+    log.basicConfig(format='%(asctime)s %(levelname)s %(message)s',
+            level=log.DEBUG)
+
+    snapshotFile = sys.argv[1] if len(sys.argv) > 1 else 'data/cards.snapshot'
+    CardDB(constants=Constants()).saveSnapshot(snapshotFile)
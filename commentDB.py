@@ -1,23 +1,44 @@
 
-import sqlite3
-import itertools
+import time
+
+from storage import Storage
+import retention
+
+
+# max parameters of one statement in old sqlite versions
+SQL_PARAM_LIMIT = 999
 
 
 class DB():
     """Keep track of parent comments to reduce duplicates.
     Often when a user mentions cards multiple people send
     the same request for the bot to explain the cards.
+    Thread-safe.
     """
 
-    def __init__(self, dbName='hscbot.db'):
-        self.conn = sqlite3.connect(dbName)
-
-        self.conn.execute("CREATE TABLE IF NOT EXISTS topcomment"
-                            " (submission_id text, card text,"
-                            " created integer(4) not null default (strftime('%s','now')))")
-        self.conn.execute('CREATE INDEX IF NOT EXISTS sub_card_idx ON topcomment (submission_id, card)')
+    def __init__(self, dbName='hscbot.db', storage=None, schema='main'):
+        """
+        :param dbName: db file, if no storage is given
+        :param storage: shared Storage with the file attached as schema,
+            committed by its owner
+        :param schema: schema name of the db file in the storage
+        """
+        self.__ownStorage = storage is None
+        self.storage = storage or Storage(dbName)
+        self.conn = self.storage.conn
+        self.schema = schema
+        self.__table = schema + '.topcomment'
 
-        self.conn.commit()
+        with self.storage.lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS {}"
+                                " (submission_id text, card text,"
+                                " created integer(4) not null default (strftime('%s','now')))"
+                                .format(self.__table))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS {}.sub_card_idx ON topcomment (submission_id, card)'
+                                .format(schema))
+            self.conn.execute('CREATE INDEX IF NOT EXISTS {}.created_idx ON topcomment (created)'
+                                .format(schema))
+        retention.enableIncrementalVacuum(self.storage, schema)
 
     def __str__(self):
         return repr(self.conn)
@@ -26,23 +47,76 @@ class DB():
         """Test if request is a duplicate and inserts new
         :return: true if all cards are already posted for parent
         """
-        query = ('SELECT card FROM topcomment '
-                    ' WHERE submission_id = ?'
-                    ' AND card IN (%s)' % ','.join('?' * len(cards)))
-        params = list(itertools.chain((submission_id,), cards))
+        return self.existsMany([(submission_id, cards)])[0]
+
+    def existsMany(self, requests):
+        """Test a batch of requests with one query, inserts new cards
+        in one transaction. Later requests see the cards of earlier ones.
+        :param requests: list of (submission_id, cards)
+        :return: list of bool, true if all cards are already posted for parent
+        """
+        with self.storage.lock:
+            posted = self.postedCards(submission_id for submission_id, _ in requests)
+            result = []
+            inserts = []
 
-        foundCards = [row[0] for row in self.conn.execute(query, params)]
-        inserted = False
+            for submission_id, cards in requests:
+                newCards = [(submission_id, card) for card in cards
+                        if (submission_id, card) not in posted]
+                posted.update(newCards)
+                inserts.extend(newCards)
+                result.append(not newCards)
 
-        for card in cards:
-            if card not in foundCards:
-                inserted = True
-                self.conn.execute("INSERT INTO topcomment (submission_id, card) VALUES (?, ?)",
-                    (submission_id, card))
+            self.addCards(inserts)
+            return result
 
-        self.conn.commit()
+    def postedCards(self, submission_ids):
+        """:return: set of (submission_id, card) already posted for the parents"""
+        ids = list(set(submission_ids))
+        posted = set()
+
+        with self.storage.lock:
+            for chunk in range(0, len(ids), SQL_PARAM_LIMIT):
+                someIds = ids[chunk:chunk + SQL_PARAM_LIMIT]
+                query = ('SELECT submission_id, card FROM {}'
+                            ' WHERE submission_id IN ({})'.format(self.__table,
+                                ','.join('?' * len(someIds))))
+                posted.update(self.conn.execute(query, someIds))
+
+        return posted
+
+    def addCards(self, cards):
+        """remember posted cards in one transaction
+        :param cards: list of (submission_id, card)
+        """
+        if not cards:
+            return
+
+        with self.storage.write() as conn:
+            conn.executemany("INSERT INTO {} (submission_id, card) VALUES (?, ?)"
+                    .format(self.__table), cards)
+        if self.__ownStorage:
+            self.storage.commit()
+
+    def cardCounts(self):
+        """:return: dict of card to number of submissions it was requested in"""
+        query = 'SELECT card, COUNT(1) FROM {} GROUP BY card'.format(self.__table)
+        with self.storage.lock:
+            return dict(self.conn.execute(query))
+
+    def prune(self, secondsOld, limit=None):
+        """forget up to limit answered cards older than n seconds
+        :return: number of forgotten cards
+        """
+        deleted = retention.pruneBatch(self.storage, 'topcomment',
+                int(time.time()) - secondsOld, limit, schema=self.schema)
+        if self.__ownStorage:
+            self.storage.commit()
+        return deleted
 
-        return not inserted
+    def vacuum(self, pages):
+        retention.vacuum(self.storage, pages, self.schema)
 
     def close(self):
-        self.conn.close()
+        if self.__ownStorage:
+            self.storage.close()
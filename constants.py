@@ -12,6 +12,8 @@ class Constants():
         with open(constantJSON, 'r', encoding='utf8') as file:
             constants = json.load(file)
 
+        self.constantJSON = constantJSON
+
         # set informations
         self.sets = constants['sets']
         self.setIds = {}
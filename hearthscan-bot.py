@@ -2,12 +2,15 @@
 
 import logging as log
 import re
+import sys
 import time
 
 from cardDB import CardDB
 from constants import Constants
 from helper import HSHelper
+from metrics import Metrics
 from praww import RedditBot
+from storage import Storage
 import commentDB
 import credentials
 import formatter
@@ -15,31 +18,33 @@ import formatter
 
 # answer pms of the same user only every x seconds
 PM_RATE_LIMIT = 60
+# prometheus text file, written after every round
+METRICS_FILE = 'metrics.prom'
+# reddit archives threads after 6 months, no duplicates possible after
+ANSWERED_AGE = 180 * 24 * 60 * 60
 
 
-def answerComment(r, comment, answeredDB, helper):
-    """read and answer a comment"""
+def replyNow(thing, text):
+    """send a reply right away, the bot queues replies instead"""
+    thing.reply(text)
+
+
+def answerComment(r, comment, roundAnswers, helper):
+    """read a comment, the answer is sent at the end of the round"""
 
     cards, answer = helper.parseText(comment.body)
 
-    if cards and answer and not answeredDB.exists(comment.parent_id, cards):
-        # reply to comment
-        log.info("replying to comment: %s %s with %s",
-                comment.id, comment.author.name, cards)
-        comment.reply(answer)
+    if cards and answer:
+        roundAnswers.append((comment, cards, answer))
 
 
-def answerMention(r, comment, answeredDB, helper):
-    """read and answer a mention"""
+def answerMention(r, comment, roundAnswers, helper):
+    """read a mention, the answer is sent at the end of the round"""
 
     cards, answer = helper.parseText(comment.body)
 
     if cards and answer:
-        if not answeredDB.exists(comment.parent_id, cards):
-            # reply to comment
-            log.info("replying to comment: %s %s with %s",
-                    comment.id, comment.author.name, cards)
-            comment.reply(answer)
+        roundAnswers.append((comment, cards, answer))
     else:
         log.debug("forwarded mention with id: %s", comment.id)
         # forward mentions without cards to admin
@@ -48,7 +53,43 @@ def answerMention(r, comment, answeredDB, helper):
         r.redditor(credentials.admin_username).message(subject, comment.body)
 
 
-def answerSubmission(submission, helper):
+def sendRoundAnswers(roundAnswers, answeredDB, reply=replyNow):
+    """reply to the comments of a round, skips cards already posted
+    for the same parent using one db query. Cards count as posted once
+    their reply is done, a failed reply does not stop the others.
+    """
+    answers = list(roundAnswers)
+    roundAnswers.clear()
+
+    if not answers:
+        return
+
+    posted = answeredDB.postedCards(comment.parent_id for comment, _, _ in answers)
+    answered = []
+
+    try:
+        for comment, cards, answer in answers:
+            newCards = [(comment.parent_id, card) for card in cards
+                    if (comment.parent_id, card) not in posted]
+            if not newCards:
+                continue
+
+            # reply to comment
+            log.info("replying to comment: %s %s with %s",
+                    comment.id, comment.author.name, cards)
+            try:
+                reply(comment, answer)
+            except Exception:
+                log.exception("sendRoundAnswers() reply to %s failed", comment.id)
+                continue
+
+            posted.update(newCards)
+            answered.extend(newCards)
+    finally:
+        answeredDB.addCards(answered)
+
+
+def answerSubmission(submission, helper, reply=replyNow):
     """read and answer a submission"""
 
     text = submission.title
@@ -61,10 +102,10 @@ def answerSubmission(submission, helper):
     if cards and answer:
         log.info("replying to submission: %s %s with %s",
                 submission.id, submission.author.name, cards)
-        submission.reply(answer)
+        reply(submission, answer)
 
 
-def answerPM(r, msg, pmUserCache, helper):
+def answerPM(r, msg, pmUserCache, helper, reply=replyNow):
     """ read and answer a pm """
 
     subject_author = ""
@@ -104,7 +145,7 @@ def answerPM(r, msg, pmUserCache, helper):
     if cards or answer:
         if cards:
             log.info("sending msg: %s with %s", author, cards)
-        msg.reply(answer)
+        reply(msg, answer)
     else:
         # vip tags (mod, admin usw)
         if msg.distinguished:
@@ -168,52 +209,93 @@ def cleanPMUserCache(cache):
         del cache[ku]
 
 
-def main():
+def main(streaming=False):
     log.debug('main() hearthscan-bot starting')
 
+    # phase times and counts
+    metrics = Metrics()
     # load constant values
     constants = Constants()
+    # one sqlite connection and transaction per round for the bot and answered comments,
+    # each file commits on its own
+    storage = Storage('praww.db', attach={'answered': 'hscbot.db'})
     # init answered comments sqlite DB
-    answeredDB = commentDB.DB()
+    answeredDB = commentDB.DB(storage=storage, schema='answered')
     # load card DB
     url = 'https://raw.githubusercontent.com/d-schmidt/hearthscan-bot/master/data/tempinfo.json'
-    cardDB = CardDB(constants=constants, tempJSONUrl=url)
+    cardDB = CardDB(constants=constants, tempJSONUrl=url,
+            snapshotFile='data/cards.snapshot')
     # init hs helper for hearthstone stuff
-    helper = HSHelper(cardDB, constants)
+    # popular cards win ties when fixing spelling errors
+    helper = HSHelper(cardDB, constants, answeredDB.cardCounts(),
+            metrics=metrics)
     # pm spam filter cache
     pmUserCache = {}
+    # comment answers of the current round
+    roundAnswers = []
 
     def submissionListener(r, submission):
-        answerSubmission(submission, helper)
+        answerSubmission(submission, helper, bot.reply)
+
+    def collectAnswer(answer, r, comment):
+        """answers wait for the end of the round, streamed ones are
+        checked and queued right away
+        """
+        if not streaming:
+            answer(r, comment, roundAnswers, helper)
+            return
+
+        answers = []
+        answer(r, comment, answers, helper)
+        metrics.count('answers', len(answers))
+        sendRoundAnswers(answers, answeredDB, bot.reply)
 
     def commentListener(r, comment):
-        answerComment(r, comment, answeredDB, helper)
+        collectAnswer(answerComment, r, comment)
 
     def mentionListener(r, comment):
-        answerMention(r, comment, answeredDB, helper)
+        collectAnswer(answerMention, r, comment)
 
     def pmListener(r, message):
-        answerPM(r, message, pmUserCache, helper)
+        answerPM(r, message, pmUserCache, helper, bot.reply)
 
     def postAction():
+        metrics.count('answers', len(roundAnswers))
+        sendRoundAnswers(roundAnswers, answeredDB, bot.reply)
         cleanPMUserCache(pmUserCache)
-        cardDB.refreshTemp()
+        cardDB.refresh()
+
+        refreshAge = cardDB.lastRefreshAge()
+        if refreshAge is not None:
+            metrics.gauge('card_refresh_age_seconds', refreshAge)
+        for cache, stats in helper.cacheStats().items():
+            for stat, value in stats.items():
+                metrics.gauge('cache_{}_{}'.format(cache, stat), value)
 
     try:
-        RedditBot(subreddits=credentials.subreddits,
+        bot = RedditBot(subreddits=credentials.subreddits,
                     newLimit=250,
                     connectAttempts=5,
-                    userBlacklist=set(credentials.userBlacklist)) \
+                    userBlacklist=set(credentials.userBlacklist),
+                    metrics=metrics,
+                    metricsFile=METRICS_FILE,
+                    storage=storage) \
                 .withSubmissionListener(submissionListener) \
                 .withCommentListener(commentListener) \
                 .withMentionListener(mentionListener) \
-                .withPMListener(pmListener) \
-                .run(postAction)
+                .withPMListener(pmListener)
+        bot.retention.add(answeredDB, ANSWERED_AGE)
+
+        if streaming:
+            bot.stream(postAction)
+        else:
+            bot.run(postAction)
     except:
         log.exception('main() RedditBot failed unexpectedly')
     finally:
         log.warning('main() leaving hearthscan-bot')
         answeredDB.close()
+        storage.close()
 
 
 if __name__ == "__main__":
@@ -226,7 +308,7 @@ if __name__ == "__main__":
 
     # start
     try:
-        main()
+        main(streaming='stream' in sys.argv[1:])
     except:
         log.exception('main() failed unexpectedly')
         exit(1)
\ No newline at end of file
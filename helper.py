@@ -1,72 +1,363 @@
 
+import collections
 import io
 import itertools
 import json
 import logging as log
+import math
 import re
-import string
+import threading
 
 import credentials
 import formatter
 from cardDB import CardDB
+from metrics import Metrics
 
 
 class SpellChecker():
     """Find and fix simple spelling errors.
-    based on Peter Norvig
-    https://norvig.com/spell-correct.html
+    based on the symmetric delete index of SymSpell
+    https://github.com/wolfgarbe/SymSpell
+
+    All deletes of the known words are indexed once, a lookup only creates
+    the deletes of the requested word and verifies the few candidates.
     """
-    def __init__(self, names):
-        self.model = set(name.lower() for name in names)
-
-    def __known(self, words):
-        for w in words:
-            if w in self.model:
-                return w
-        return None
-
-    def __edits(self, word):
-        splits     = [(word[:i], word[i:]) for i in range(len(word) + 1)]
-        deletes    = (a + b[1:] for a, b in splits if b)
-        transposes = (a + b[1] + b[0] + b[2:] for a, b in splits if len(b)>1)
-        replaces   = (a + c + b[1:] for a, b in splits for c in string.ascii_lowercase if b)
-        inserts    = (a + c + b     for a, b in splits for c in string.ascii_lowercase)
-        return itertools.chain(deletes, transposes, replaces, inserts)
-
-    def __edits2(self, word):
-        # distance 2 errors
-        # insert: or self.__known(self.__edits2(lword))
-        return set(e2 for e1 in self.__edits(word) for e2 in self.__edits(e1))
+    def __init__(self, names, frequencies=None, maxDistance=2, longWord=8,
+            prefixLength=7):
+        """
+        :param names: known words
+        :param frequencies: optional dict of word to popularity (request count)
+        :param maxDistance: max edit distance of fixed words
+        :param longWord: shorter words only get distance 1 fixes
+        :param prefixLength: only the prefix is indexed, limits index size
+        """
+        self.frequencies = frequencies = frequencies or {}
+        self.__maxFrequency = max(frequencies.values(), default=0)
+        self.maxDistance = maxDistance
+        self.longWord = longWord
+        self.prefixLength = prefixLength
+
+        self.model = set()
+        # deletes per distance, distance 1 fixes only need the first two
+        self.__deletes = [{} for _ in range(maxDistance + 1)]
+
+        for name in names:
+            self.add(name)
+
+    def add(self, word):
+        """add a known word to the index"""
+        word = word.lower()
+        if word in self.model:
+            return
+        self.model.add(word)
+
+        for distance, deletes in enumerate(
+                self.__edits(word[:self.prefixLength], self.maxDistance)):
+            for delete in deletes:
+                self.__deletes[distance].setdefault(delete, []).append(word)
+
+    def remove(self, word):
+        """remove a known word from the index"""
+        word = word.lower()
+        if word not in self.model:
+            return
+        self.model.discard(word)
+
+        for distance, deletes in enumerate(
+                self.__edits(word[:self.prefixLength], self.maxDistance)):
+            index = self.__deletes[distance]
+            for delete in deletes:
+                index[delete].remove(word)
+                if not index[delete]:
+                    del index[delete]
+
+    def __edits(self, word, distance):
+        """list of sets, word and its deletes per distance"""
+        result = [{word}]
+        for _ in range(distance):
+            result.append(set(w[:i] + w[i + 1:] for w in result[-1]
+                    for i in range(len(w))))
+        return result
 
     def correct(self, word):
         """returns input word or fixed version if found"""
         lword = word.lower()
-        return self.__known([lword]) or self.__known(self.__edits(lword)) or word
+        if lword in self.model:
+            return lword
+
+        maxDistance = 1 if len(lword) < self.longWord else self.maxDistance
+        edits = self.__edits(lword[:self.prefixLength], maxDistance)
+
+        # closer fixes first, more distance only if nothing was found
+        for distance in range(1, maxDistance + 1):
+            found = []
+            seen = set()
+
+            for deletes in edits[:distance + 1]:
+                for delete in deletes:
+                    for index in self.__deletes[:distance + 1]:
+                        for candidate in index.get(delete, ()):
+                            if candidate in seen or \
+                                    abs(len(candidate) - len(lword)) > distance:
+                                continue
+                            seen.add(candidate)
+
+                            if _distance(lword, candidate, distance) <= distance:
+                                found.append(candidate)
+
+            if len(found) == 1:
+                return found[0]
+            if found:
+                return min(found, key=lambda c: (self.__score(lword, c), c))
+
+        return word
+
+    def __score(self, word, candidate):
+        """lower is better: typing error cost minus popularity bonus"""
+        score = _typoCost(word, candidate)
+        frequency = self.frequencies.get(candidate)
+        if frequency:
+            score -= POPULARITY_WEIGHT * math.log1p(frequency) \
+                    / math.log1p(self.__maxFrequency)
+        return score
+
+
+# edit costs of likely typing errors, all other edits cost 1
+ADJACENT_KEY_COST = 0.6
+TRANSPOSE_COST = 0.7
+DOUBLE_KEY_COST = 0.7
+# the most requested card gets this bonus
+POPULARITY_WEIGHT = 0.3
+
+
+def _keyboardNeighbours(rows=('qwertyuiop', 'asdfghjkl', 'zxcvbnm'),
+        shifts=(0, 0.25, 0.75)):
+    """pairs of keys next to each other on a qwerty keyboard"""
+    positions = {key: (y, x + shifts[y])
+            for y, row in enumerate(rows) for x, key in enumerate(row)}
+    return set((a, b) for a, (ay, ax) in positions.items()
+            for b, (by, bx) in positions.items()
+            if a != b and abs(ay - by) <= 1 and abs(ax - bx) <= 1)
+
+_NEIGHBOURS = _keyboardNeighbours()
+
+
+def _typoCost(a, b):
+    """weighted edit cost of typing a instead of b"""
+    previous = None
+    current = [float(j) for j in range(len(b) + 1)]
+
+    for i in range(1, len(a) + 1):
+        before, previous = previous, current
+        current = [float(i)] + [0.0] * len(b)
+        ai = a[i - 1]
+
+        for j in range(1, len(b) + 1):
+            bj = b[j - 1]
+            if ai == bj:
+                change = 0.0
+            elif (ai, bj) in _NEIGHBOURS:
+                change = ADJACENT_KEY_COST
+            else:
+                change = 1.0
+            # a pressed twice or a missing double letter is a cheap insert
+            insert = DOUBLE_KEY_COST if i > 1 and ai == a[i - 2] else 1.0
+            delete = DOUBLE_KEY_COST if j > 1 and bj == b[j - 2] else 1.0
+
+            value = min(previous[j - 1] + change,
+                    previous[j] + insert,
+                    current[j - 1] + delete)
+            if i > 1 and j > 1 and ai == b[j - 2] and a[i - 2] == bj:
+                value = min(value, before[j - 2] + TRANSPOSE_COST)
+            current[j] = value
+
+    return current[len(b)]
+
+
+def _distance(a, b, limit):
+    """optimal string alignment distance (adjacent transposes allowed),
+    anything above limit is returned as limit + 1
+    """
+    # typos are local, skip the equal start and end
+    start = 0
+    while start < len(a) and start < len(b) and a[start] == b[start]:
+        start += 1
+    end = 0
+    while end < len(a) - start and end < len(b) - start \
+            and a[-1 - end] == b[-1 - end]:
+        end += 1
+    a = a[start:len(a) - end]
+    b = b[start:len(b) - end]
+
+    if not a or not b:
+        return min(max(len(a), len(b)), limit + 1)
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+
+    # only a band of width 2 * limit + 1 can stay below the limit
+    tooFar = limit + 1
+    previous = None
+    current = [j if j <= limit else tooFar for j in range(len(b) + 1)]
+
+    for i in range(1, len(a) + 1):
+        before, previous = previous, current
+        current = [tooFar] * (len(b) + 1)
+        if i <= limit:
+            current[0] = i
+        rowMin = current[0]
+        ai = a[i - 1]
+
+        for j in range(max(1, i - limit), min(len(b), i + limit) + 1):
+            bj = b[j - 1]
+            value = previous[j - 1] + (ai != bj)
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and ai == b[j - 2] and a[i - 2] == bj \
+                    and before[j - 2] + 1 < value:
+                value = before[j - 2] + 1
+            if value > tooFar:
+                value = tooFar
+            current[j] = value
+            if value < rowMin:
+                rowMin = value
+
+        if rowMin > limit:
+            return tooFar
+
+    return current[len(b)]
+
+
+_MISSING = object()
+
+
+class LRUCache():
+    """size bounded dict, drops the least recently used entries"""
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self.__data = collections.OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.__data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        self.__data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self.__data[key] = value
+        self.__data.move_to_end(key)
+        if len(self.__data) > self.maxSize:
+            self.__data.popitem(last=False)
+
+    def clear(self):
+        self.__data.clear()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self.__data)}
+
+    def __len__(self):
+        return len(self.__data)
 
 
 class HSHelper:
-    """some convenience methods and wraps cardDB"""
+    """some convenience methods and wraps cardDB, parseText is thread-safe"""
 
-    def __init__(self, cardDB, constants):
+    def __init__(self, cardDB, constants, cardCounts=None, cacheSize=1024,
+            metrics=None):
+        """
+        :param cardDB: the cards
+        :param constants: the constants
+        :param cardCounts: optional dict of card to times requested, ranks
+            spelling fixes
+        :param cacheSize: max entries of each parse cache
+        :param metrics: Metrics to record parse and answer times in
+        """
         self.cardDB = cardDB
         self.constants = constants
+        self.metrics = metrics or Metrics()
+
+        # requested [[name]] to card key and card keys to answer text
+        self.__requests = LRUCache(cacheSize)
+        self.__answers = LRUCache(cacheSize)
+        self.__generation = cardDB.generation
+        # caches and spell checker are shared by listener threads
+        self.__lock = threading.Lock()
 
-        allNames = itertools.chain(cardDB.cardNames(),
+        # duels and vanilla requests count for the plain name
+        frequencies = {}
+        for card, count in (cardCounts or {}).items():
+            for prefix in (cardDB.DUELS_CMD, cardDB.VANILLA_CMD):
+                if card.startswith(prefix):
+                    card = card[len(prefix):]
+            frequencies[card] = frequencies.get(card, 0) + count
+
+        self.__cardNames = set(cardDB.cardNames())
+        allNames = itertools.chain(self.__cardNames,
                 self.constants.specialNames,
                 self.constants.alternativeNames)
-        self.spellChecker = SpellChecker(allNames)
+        self.spellChecker = SpellChecker(allNames, frequencies)
+
+        self.__loadInfoTempl()
 
+    def __loadInfoTempl(self):
+        self.__tokens = self.cardDB.tokens
         self.infoTempl = formatter.loadInfoTempl(self.constants.specialNames,
             self.constants.alternativeNames,
-            cardDB.tokens,
-            cardDB.DUELS_CMD)
+            self.__tokens,
+            self.cardDB.DUELS_CMD)
 
     def getInfoText(self, author):
         """fill info request answer template"""
         return self.infoTempl.format(user=author)
 
+    def cacheStats(self):
+        """hits, misses and size of the parse caches"""
+        return {
+            'tokens': self.__requests.stats(),
+            'answers': self.__answers.stats()
+        }
+
+    def __checkGeneration(self):
+        """forget cached results and update names when the card db changed"""
+        if self.__generation == self.cardDB.generation:
+            return
+
+        log.debug("checkGeneration() card db changed, clearing caches")
+        self.__generation = self.cardDB.generation
+        self.__requests.clear()
+        self.__answers.clear()
+
+        # only changed names are updated in the spelling index
+        cardNames = set(self.cardDB.cardNames())
+        for name in cardNames - self.__cardNames:
+            self.spellChecker.add(name)
+        for name in self.__cardNames - cardNames:
+            if name not in self.constants.specialNames \
+                    and name not in self.constants.alternativeNames:
+                self.spellChecker.remove(name)
+        self.__cardNames = cardNames
+
+        if self.__tokens is not self.cardDB.tokens:
+            self.__loadInfoTempl()
+
     def parseText(self, text):
         """returns found cards and answer text"""
+        with self.__lock, self.metrics.timer('parse'):
+            return self.__parseText(text)
+
+    def __parseText(self, text):
+        self.__checkGeneration()
+
         text = HSHelper.removeQuotes(text)
         cards = self.__getCards(text)
         answer = ''
@@ -76,7 +367,13 @@ class HSHelper:
             cards = self.constants.replaceSpecial(cards) #expand
             cards = [card for card in cards if card in self.cardDB]
             cards = cards[:self.constants.CARD_LIMIT]
-            answer = formatter.createAnswer(self.cardDB, cards)
+
+            key = tuple(cards)
+            answer = self.__answers.get(key)
+            if answer is None:
+                with self.metrics.timer('answer'):
+                    answer = formatter.createAnswer(self.cardDB, cards)
+                self.__answers.put(key, answer)
 
         return cards, answer
 
@@ -100,29 +397,13 @@ class HSHelper:
         for card in re.finditer(r'\\?\[\\?\[([^\]\\]{1,32})\\?\]\\?\]', text):
             card = card.group(1)
             log.debug("adding a card: %s", card)
-            duelsRequested = card.startswith(self.cardDB.DUELS_CMD)
-            if duelsRequested:
-                card = card[len(self.cardDB.DUELS_CMD):]
-            vanillaRequested = card.startswith(self.cardDB.VANILLA_CMD)
-            if vanillaRequested:
-                card = card[len(self.cardDB.VANILLA_CMD):]
-            cleanCard = CardDB.cleanName(card)
-
-            if cleanCard:
-                log.debug("cleaned card name: %s", cleanCard)
-                # slight spelling error?
-                checkedCard = self.spellChecker.correct(cleanCard)
-                if cleanCard != checkedCard:
-                    log.info("spelling fixed: %s -> %s",
-                        cleanCard, checkedCard)
-
-                # is alternative name?
-                checkedCard = self.constants.translateAlt(checkedCard)
-
-                if duelsRequested:
-                    checkedCard = self.cardDB.DUELS_CMD + checkedCard
-                if vanillaRequested:
-                    checkedCard = self.cardDB.VANILLA_CMD + checkedCard
+
+            checkedCard = self.__requests.get(card, _MISSING)
+            if checkedCard is _MISSING:
+                checkedCard = self.__resolveCard(card)
+                self.__requests.put(card, checkedCard)
+
+            if checkedCard:
                 # add cardname
                 if checkedCard not in cards:
                     cards.append(checkedCard)
@@ -134,3 +415,33 @@ class HSHelper:
                 break
 
         return cards
+
+    def __resolveCard(self, card):
+        """card key of a requested card or None"""
+        duelsRequested = card.startswith(self.cardDB.DUELS_CMD)
+        if duelsRequested:
+            card = card[len(self.cardDB.DUELS_CMD):]
+        vanillaRequested = card.startswith(self.cardDB.VANILLA_CMD)
+        if vanillaRequested:
+            card = card[len(self.cardDB.VANILLA_CMD):]
+        cleanCard = CardDB.cleanName(card)
+
+        if not cleanCard:
+            return None
+
+        log.debug("cleaned card name: %s", cleanCard)
+        # slight spelling error?
+        checkedCard = self.spellChecker.correct(cleanCard)
+        if cleanCard != checkedCard:
+            log.info("spelling fixed: %s -> %s",
+                cleanCard, checkedCard)
+
+        # is alternative name?
+        checkedCard = self.constants.translateAlt(checkedCard)
+
+        if duelsRequested:
+            checkedCard = self.cardDB.DUELS_CMD + checkedCard
+        if vanillaRequested:
+            checkedCard = self.cardDB.VANILLA_CMD + checkedCard
+
+        return checkedCard
@@ -0,0 +1,115 @@
+
+import bisect
+import contextlib
+import logging as log
+import os
+import threading
+import time
+
+
+# upper bounds of histogram buckets in seconds
+BUCKETS = (0.0001, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+
+
+class _Histogram():
+    """counts of observed values per bucket, sum and count"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics():
+    """Thread-safe counters, gauges and latency histograms.
+    Written in the prometheus text format, e.g. for the node exporter
+    textfile collector.
+    """
+
+    def __init__(self, prefix='hearthscan', buckets=BUCKETS):
+        self.prefix = prefix
+        self.buckets = buckets
+        self.__lock = threading.Lock()
+        self.__counters = {}
+        self.__gauges = {}
+        self.__histograms = {}
+
+    def count(self, name, value=1):
+        """add to counter name_total"""
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def observe(self, name, seconds):
+        """add to histogram name_seconds"""
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            if histogram is None:
+                histogram = self.__histograms[name] = _Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        """observe the time of the with block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def counter(self, name):
+        with self.__lock:
+            return self.__counters.get(name, 0)
+
+    def histogram(self, name):
+        """:return: (count, sum) of the histogram"""
+        with self.__lock:
+            histogram = self.__histograms.get(name)
+            return (histogram.count, histogram.sum) if histogram else (0, 0)
+
+    def text(self):
+        """all metrics in prometheus text format"""
+        lines = []
+
+        with self.__lock:
+            for name, value in sorted(self.__counters.items()):
+                metric = '{}_{}_total'.format(self.prefix, name)
+                lines.append('# TYPE {} counter'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+
+            for name, value in sorted(self.__gauges.items()):
+                metric = '{}_{}'.format(self.prefix, name)
+                lines.append('# TYPE {} gauge'.format(metric))
+                lines.append('{} {}'.format(metric, value))
+
+            for name, histogram in sorted(self.__histograms.items()):
+                metric = '{}_{}_seconds'.format(self.prefix, name)
+                lines.append('# TYPE {} histogram'.format(metric))
+                total = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    total += count
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric, bound, total))
+                lines.append('{}_bucket{{le="+Inf"}} {}'.format(metric, histogram.count))
+                lines.append('{}_sum {}'.format(metric, histogram.sum))
+                lines.append('{}_count {}'.format(metric, histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, fileName):
+        """write to file, readers never see half a file"""
+        tmpFile = fileName + '.tmp'
+        try:
+            with open(tmpFile, 'w', encoding='utf8', newline='\n') as f:
+                f.write(self.text())
+            os.replace(tmpFile, fileName)
+        except OSError:
+            log.exception('dump() failed to write metrics %s', fileName)
@@ -1,58 +1,441 @@
 
+import collections
+import hashlib
 import logging as log
+import math
 import os
+import re
 import signal
-import sqlite3
 import sys
+import threading
 import time
 
 import praw
+from praw.endpoints import API_PATH
 from praw.models import Message, Comment
 import prawcore
 
+from metrics import Metrics
+from retention import Retention
+from storage import Storage
+import retention
+
 
 def _now():
     return int(time.time())
 
 
-class _SeenDB():
-    """Bot caches seen things to not supply them twice to listeners."""
+class RateLimited(Exception):
+    """no request possible now, try again in seconds"""
+
+    def __init__(self, seconds):
+        super().__init__('rate limited for {:.0f} sec'.format(seconds))
+        self.seconds = seconds
+
+
+class _TokenBucket():
+    """Thread-safe token bucket, take() waits for the next token but
+    never for a pause. Waiting callers are served in order.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.__tokens = capacity
+        self.__updated = time.monotonic()
+        self.__until = 0
+        self.__lock = threading.Lock()
+        self.__turn = threading.Lock()
+
+    def __refill(self, now):
+        self.__tokens = min(self.capacity,
+                self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def __paused(self, now):
+        if self.__until and now >= self.__until:
+            # pause is over, go on right away
+            self.__until = 0
+            self.__tokens = max(self.__tokens, 1)
+        return max(self.__until - now, 0)
+
+    def pausedFor(self):
+        """:return: seconds until the pause ends, 0 if not paused"""
+        with self.__lock:
+            return self.__paused(time.monotonic())
+
+    def take(self, cancel=None):
+        """take a token
+
+        :param cancel: function() true to stop waiting
+        :return: false if paused or cancelled, no token was taken
+        """
+        with self.__turn:
+            while True:
+                with self.__lock:
+                    now = time.monotonic()
+                    self.__refill(now)
+
+                    if self.__paused(now):
+                        return False
+                    if self.__tokens >= 1:
+                        self.__tokens -= 1
+                        return True
+                    wait = (1 - self.__tokens) / self.rate
+
+                if cancel and cancel():
+                    return False
+                # rate changes are noticed every second
+                time.sleep(min(wait, 1))
+
+    def setRate(self, rate, tokens=None):
+        with self.__lock:
+            self.__refill(time.monotonic())
+            self.rate = max(rate, 0.001)
+            if tokens is not None:
+                self.__tokens = min(self.__tokens, tokens)
+
+    def pause(self, seconds):
+        """no tokens for n seconds"""
+        with self.__lock:
+            self.__refill(time.monotonic())
+            self.__tokens = 0
+            self.__until = time.monotonic() + seconds
+
+
+class _RateLimiter():
+    """Paces requests to stay below reddit's limits. Reads and writes
+    have their own token bucket, both share the bucket of the reddit
+    quota, which is spread until the reset of the X-Ratelimit headers.
+    """
+
+    def __init__(self, readRate=1, writeRate=0.5, burst=5, cancel=None):
+        """:param cancel: function() true to stop waiting, e.g. when killed"""
+        self.reads = _TokenBucket(readRate, burst)
+        self.writes = _TokenBucket(writeRate, burst)
+        self.quota = _TokenBucket(readRate, burst)
+        self.cancel = cancel
+
+    def acquire(self, write):
+        """wait for the next request slot
+
+        :raises RateLimited: while paused or cancelled
+        """
+        for bucket in (self.writes if write else self.reads, self.quota):
+            if not bucket.take(self.cancel):
+                raise RateLimited(bucket.pausedFor())
+
+    def update(self, headers):
+        """read reddit's X-Ratelimit-Remaining and -Reset"""
+        remaining = headers.get('x-ratelimit-remaining')
+        reset = headers.get('x-ratelimit-reset')
+        if remaining is None or reset is None:
+            return
+
+        remaining = float(remaining)
+        reset = max(int(reset), 1)
+
+        if remaining < 1:
+            log.warning('update() reddit quota used up, waiting %s sec', reset)
+            self.quota.pause(reset)
+        else:
+            self.quota.setRate(remaining / reset, remaining)
+
+    def pauseWrites(self, seconds):
+        self.writes.pause(seconds)
+
+    def writesPausedFor(self):
+        """:return: seconds until writes are possible again"""
+        return max(self.writes.pausedFor(), self.quota.pausedFor())
+
+
+class _LimitedRequestor(prawcore.Requestor):
+    """prawcore requestor asking the rate limiter before each api call"""
+
+    def __init__(self, *args, limiter, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.limiter = limiter
+
+    def request(self, *args, **kwargs):
+        method = args[0] if args else kwargs.get('method', 'GET')
+        url = args[1] if len(args) > 1 else kwargs.get('url', '')
+        # token requests are not part of the api quota
+        api = url.startswith(self.oauth_url)
 
-    def __init__(self, dbName = 'praww.db'):
-        self.conn = sqlite3.connect(dbName)
+        if api:
+            self.limiter.acquire(method.upper() != 'GET')
 
-        self.conn.execute("CREATE TABLE IF NOT EXISTS seen"
-                            " (id TEXT NOT NULL,"
-                            " created INTEGER(4) NOT NULL DEFAULT (strftime('%s','now')))")
-        self.conn.execute('CREATE INDEX IF NOT EXISTS seen_idx ON seen (id)')
-        self.conn.commit()
+        response = super().request(*args, **kwargs)
+
+        if api:
+            self.limiter.update(response.headers)
+        return response
+
+
+def _rateLimitSeconds(message, default):
+    """seconds of 'try again in 5 minutes' of a RATELIMIT error"""
+    match = re.search(r'(\d+) (minute|second)', message or '')
+    if not match:
+        return default
+    seconds = int(match.group(1))
+    return seconds * 60 if match.group(2) == 'minute' else seconds
+
+
+class _BloomFilter():
+    """Set without false negatives and few false positives.
+    Memory stays small, elements can't be removed.
+    """
+
+    def __init__(self, capacity, errorRate=0.001):
+        self.capacity = capacity
+        self.count = 0
+        self.__size = max(8, int(-capacity * math.log(errorRate)
+                / (math.log(2) ** 2)))
+        self.__hashes = max(1, round(self.__size / capacity * math.log(2)))
+        self.__bits = bytearray((self.__size + 7) // 8)
+
+    def __positions(self, key):
+        digest = hashlib.blake2b(key.encode('utf8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.__size for i in range(self.__hashes))
+
+    def add(self, key):
+        for pos in self.__positions(key):
+            self.__bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        return all(self.__bits[pos >> 3] & (1 << (pos & 7))
+                for pos in self.__positions(key))
+
+
+class _SeenDB():
+    """Bot caches seen things to not supply them twice to listeners.
+    Recently seen ids and a bloom filter of all ids are kept in memory,
+    sqlite is only asked when the bloom filter is unsure. New ids are
+    written with flush() into the transaction of the round. Thread-safe.
+    """
+
+    def __init__(self, dbName = 'praww.db', recentSize=10000,
+            bloomCapacity=100000, storage=None):
+        """
+        :param dbName: db file, if no storage is given
+        :param storage: shared Storage, committed by its owner
+        """
+        self.__ownStorage = storage is None
+        self.storage = storage or Storage(dbName)
+        self.conn = self.storage.conn
+        self.__lock = self.storage.lock
+
+        with self.__lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS seen"
+                                " (id TEXT NOT NULL,"
+                                " created INTEGER(4) NOT NULL DEFAULT (strftime('%s','now')))")
+            self.conn.execute('CREATE INDEX IF NOT EXISTS seen_idx ON seen (id)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS seen_created_idx ON seen (created)')
+        retention.enableIncrementalVacuum(self.storage)
+
+        self.recentSize = recentSize
+        self.bloomCapacity = bloomCapacity
+        # id to created, oldest first
+        self.__recent = collections.OrderedDict()
+        self.__pending = {}
+        self.__rebuild()
 
     def __str__(self):
         return repr(self.conn)
 
-    def isSeen(self, thing):
-        id = thing.fullname
+    def __rebuild(self):
+        """fill bloom filter and recent ids from the table"""
+        self.__recent.clear()
 
-        query = 'SELECT COUNT(1) FROM seen WHERE id = ?'
-        cur = self.conn.execute(query, (id, ))
-        count = cur.fetchone()[0]
-        cur.close()
+        with self.__lock:
+            count = self.conn.execute('SELECT COUNT(1) FROM seen').fetchone()[0]
+            # twice the ids, rebuilt only after as many new ones
+            self.__bloom = _BloomFilter(max(self.bloomCapacity, 2 * count))
+            for id, created in self.conn.execute(
+                    'SELECT id, created FROM seen ORDER BY created'):
+                self.__bloom.add(id)
+                self.__remember(id, created)
 
-        seen = count >= 1
+    def __remember(self, id, created):
+        self.__recent[id] = created
+        if len(self.__recent) > self.recentSize:
+            self.__recent.popitem(last=False)
 
-        if not seen:
-            self.conn.execute("INSERT INTO seen (id) VALUES (?)", (id, ))
-            self.conn.commit()
+    def isSeen(self, thing):
+        with self.__lock:
+            return self.__isSeen(thing.fullname)
+
+    def __isSeen(self, id):
+        if id in self.__recent or id in self.__pending:
+            return True
+
+        if id in self.__bloom:
+            # maybe seen long ago, ask the table
+            query = 'SELECT COUNT(1) FROM seen WHERE id = ?'
+            cur = self.conn.execute(query, (id, ))
+            count = cur.fetchone()[0]
+            cur.close()
+
+            if count >= 1:
+                return True
+
+        created = _now()
+        self.__pending[id] = created
+        self.__remember(id, created)
+        self.__bloom.add(id)
+
+        return False
+
+    def forget(self, thing):
+        """a thing seen in this round is new again, e.g. its listener failed"""
+        with self.__lock:
+            if self.__pending.pop(thing.fullname, None) is not None:
+                self.__recent.pop(thing.fullname, None)
+
+    def flush(self):
+        """write new ids into the transaction of the round"""
+        with self.__lock:
+            if not self.__pending:
+                return
+
+            with self.storage.write() as conn:
+                conn.executemany("INSERT INTO seen (id, created) VALUES (?, ?)",
+                        self.__pending.items())
+            self.__pending.clear()
 
-        return seen
+            if self.__bloom.count > self.__bloom.capacity:
+                self.__rebuild()
 
     def cleanup(self, secondsOld = 24 * 60 * 60):
-        timestamp = _now() - secondsOld
-        self.conn.execute("DELETE FROM seen WHERE created <= ?", (timestamp, ))
-        self.conn.commit()
+        """forget all ids older than n seconds"""
+        self.prune(secondsOld)
+
+    def prune(self, secondsOld, limit=None):
+        """forget up to limit ids older than n seconds, oldest first
+        :return: number of forgotten ids
+        """
+        with self.__lock:
+            self.flush()
+            timestamp = _now() - secondsOld
+            deleted = retention.pruneBatch(self.storage, 'seen', timestamp, limit)
+
+            while self.__recent:
+                id, created = next(iter(self.__recent.items()))
+                if created > timestamp:
+                    break
+                del self.__recent[id]
+
+            return deleted
+
+    def vacuum(self, pages):
+        retention.vacuum(self.storage, pages)
+
+    def close(self):
+        with self.__lock:
+            self.flush()
+            if self.__ownStorage:
+                self.storage.close()
+
+
+class _Outbox():
+    """Replies waiting to be sent, kept in sqlite until reddit took them.
+    One reply per thing, sent replies are remembered for a while.
+    Writes join the transaction of the round. Thread-safe.
+    """
+    # seconds until the first retry, doubles with each attempt
+    RETRY_BASE = 30
+    RETRY_MAX = 60 * 60
+    MAX_ATTEMPTS = 8
+
+    def __init__(self, dbName='praww.db', storage=None):
+        """
+        :param dbName: db file, if no storage is given
+        :param storage: shared Storage, committed by its owner
+        """
+        self.__ownStorage = storage is None
+        self.storage = storage or Storage(dbName)
+        self.conn = self.storage.conn
+        self.__lock = self.storage.lock
+
+        with self.__lock:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS outbox"
+                                " (fullname TEXT PRIMARY KEY,"
+                                " body TEXT NOT NULL,"
+                                " attempts INTEGER NOT NULL DEFAULT 0,"
+                                " due INTEGER NOT NULL,"
+                                " sent INTEGER NOT NULL DEFAULT 0,"
+                                " created INTEGER(4) NOT NULL DEFAULT (strftime('%s','now')))")
+            self.conn.execute('CREATE INDEX IF NOT EXISTS outbox_due_idx ON outbox (sent, due)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS outbox_created_idx ON outbox (created)')
+        retention.enableIncrementalVacuum(self.storage)
+
+    def __str__(self):
+        return repr(self.conn)
+
+    def put(self, fullname, body):
+        """:return: false if the thing already has a reply"""
+        with self.storage.write() as conn:
+            cur = conn.execute("INSERT OR IGNORE INTO outbox (fullname, body, due)"
+                    " VALUES (?, ?, ?)", (fullname, body, _now()))
+            return cur.rowcount == 1
+
+    def due(self, limit):
+        """:return: list of (fullname, body, attempts) to send now"""
+        query = ('SELECT fullname, body, attempts FROM outbox'
+                    ' WHERE sent = 0 AND due <= ? ORDER BY due LIMIT ?')
+        with self.__lock:
+            return self.conn.execute(query, (_now(), limit)).fetchall()
+
+    def update(self, sent=(), failed=(), dropped=()):
+        """write the results of a batch
+
+        :param sent: fullnames reddit took
+        :param failed: (fullname, attempts) to retry later
+        :param dropped: fullnames to give up
+        """
+        now = _now()
+        retries = []
+        dropped = list(dropped)
+        for fullname, attempts in failed:
+            attempts += 1
+            if attempts >= self.MAX_ATTEMPTS:
+                log.error('update() giving up reply to %s', fullname)
+                dropped.append(fullname)
+            else:
+                delay = min(self.RETRY_BASE * 2 ** (attempts - 1), self.RETRY_MAX)
+                retries.append((attempts, now + delay, fullname))
+
+        with self.storage.write() as conn:
+            conn.executemany("UPDATE outbox SET sent = 1 WHERE fullname = ?",
+                    ((fullname, ) for fullname in sent))
+            conn.executemany("UPDATE outbox SET attempts = ?, due = ? WHERE fullname = ?",
+                    retries)
+            conn.executemany("DELETE FROM outbox WHERE fullname = ?",
+                    ((fullname, ) for fullname in dropped))
+
+    def postpone(self, fullnames, seconds):
+        """send later without counting an attempt"""
+        due = _now() + int(math.ceil(seconds))
+        with self.storage.write() as conn:
+            conn.executemany("UPDATE outbox SET due = ? WHERE fullname = ?",
+                    ((due, fullname) for fullname in fullnames))
+
+    def prune(self, secondsOld, limit=None):
+        """forget up to limit sent replies older than n seconds
+        :return: number of forgotten replies
+        """
+        return retention.pruneBatch(self.storage, 'outbox',
+                _now() - secondsOld, limit, where='sent = 1')
+
+    def vacuum(self, pages):
+        retention.vacuum(self.storage, pages)
 
     def close(self):
-        self.conn.close()
+        if self.__ownStorage:
+            self.storage.close()
 
 
 class RedditBot:
@@ -74,13 +457,38 @@ class RedditBot:
     user_agent=praw:hearthscanexample:1.0 (by /u/b0ne123)
     """
     LOCK_FILE = 'lockfile.lock'
+    # read a full page every n rounds, in case the cursor skipped things
+    FULL_PAGE_ROUNDS = 20
+    # check the thing of a cursor after n empty rounds, a deleted one hides newer things
+    CURSOR_EMPTY_ROUNDS = 3
+    # shortest pause between stream reads
+    STREAM_MIN_PAUSE = 1
+    # things read from one stream per pass at most, the others wait meanwhile
+    STREAM_BATCH = 100
+    # api requests per second and burst size, reddit allows 1/s on average
+    READ_RATE = 1
+    WRITE_RATE = 0.5
+    RATE_BURST = 5
+    # replies sent per round at most
+    OUTBOX_BATCH = 50
+    # inbox things marked read per request
+    MARK_READ_BATCH = 100
+    # seconds to remember seen things and sent replies
+    SEEN_AGE = 24 * 60 * 60
+    # errors of replies which never succeed
+    # https://github.com/reddit/reddit/blob/master/r2/r2/lib/errors.py
+    REPLY_DROP_ERRORS = {'DELETED_COMMENT', 'DELETED_LINK', 'THREAD_LOCKED',
+            'TOO_OLD', 'NOT_WHITELISTED_BY_USER_MESSAGE'}
 
 
     def __init__(self, *, subreddits, iniSite='bot',
             newLimit=25, sleep=30, connectAttempts=1,
             scopes=('submit', 'privatemessages', 'read', 'identity'),
             dbName='praww.db',
-            userBlacklist=[]):
+            userBlacklist=[],
+            metrics=None,
+            metricsFile=None,
+            storage=None):
         """Create an instance of Reddit. Does not yet connect.
 
         :param subreddits: list of subreddits to read
@@ -92,6 +500,10 @@ class RedditBot:
         :param scopes: required scopes
         :param dbName: name of file of seen-things db
         :param userBlacklist: users to ignore
+        :param metrics: Metrics to record phase times and counts in
+        :param metricsFile: write metrics to this file after every round
+        :param storage: Storage to share with other stores, opens dbName
+            if not given. The bot commits it after every round.
         """
         self.killed = False
         signal.signal(signal.SIGTERM, self.__catchKill)
@@ -103,10 +515,22 @@ class RedditBot:
         self.connectAttempts = connectAttempts
         self.scopes = scopes
         self.dbName = dbName
+        self.storage = storage
         self.userBlacklist = userBlacklist
+        self.metrics = metrics or Metrics()
+        self.metricsFile = metricsFile
+        # add more stores to prune with retention.add()
+        self.retention = Retention()
 
-        self.rateSleep = 0
+        self.limiter = _RateLimiter(self.READ_RATE, self.WRITE_RATE,
+                self.RATE_BURST, cancel=lambda: self.killed)
         self.roundStart = 0
+        self.rounds = 0
+
+        # listing name to fullname of the newest thing already read
+        self.__cursors = {}
+        self.__newest = {}
+        self.__emptyRounds = {}
 
         # restart after 15 min of consecutive fails
         self.__failLimit = 15*60 // max(sleep, 1)
@@ -164,19 +588,79 @@ class RedditBot:
 
 
     def __sleep(self):
-        if self.rateSleep > 0:
-            seconds = self.rateSleep
-            self.rateSleep = 0
-        else:
-            roundSecs = _now() - self.roundStart
-            seconds = self.sleep - min(self.sleep, roundSecs)
+        roundSecs = _now() - self.roundStart
+        self.__pause(self.sleep - min(self.sleep, roundSecs))
 
+
+    def __pause(self, seconds):
+        """sleep, wakes up when killed"""
         for i in range(int(seconds)):
             if self.killed:
                 return
             time.sleep(1)
 
 
+    def __listing(self, name, listing):
+        """Read things newer than the cursor of the listing or
+        a full page without cursor. See __advance().
+
+        :param name: name of the cursor
+        :param listing: function(limit, params) returning a ListingGenerator
+        """
+        cursor = self.__cursors.get(name)
+
+        if cursor and self.rounds % self.FULL_PAGE_ROUNDS:
+            # one page only, reddit ignores before if after is set
+            things = listing(limit=min(self.newLimit, 100),
+                    params={'before': cursor})
+        else:
+            things = listing(limit=self.newLimit)
+
+        # time spent reading, not in listeners
+        fetch = 0
+        start = time.perf_counter()
+        try:
+            for thing in things:
+                fetch += time.perf_counter() - start
+                self.metrics.count('fetched')
+                self.__newest.setdefault(name, thing.fullname)
+                yield thing
+                start = time.perf_counter()
+            fetch += time.perf_counter() - start
+        finally:
+            self.metrics.observe('fetch', fetch)
+
+
+    def __advance(self, name):
+        """move the cursor after all things were given to listeners"""
+        newest = self.__newest.pop(name, None)
+
+        if newest:
+            self.__cursors[name] = newest
+            self.__emptyRounds[name] = 0
+        elif name in self.__cursors:
+            self.__emptyRounds[name] += 1
+            if self.__emptyRounds[name] >= self.CURSOR_EMPTY_ROUNDS:
+                self.__emptyRounds[name] = 0
+                if not self.__cursorValid(self.__cursors[name]):
+                    log.debug("advance() %s cursor is gone, reading a full page", name)
+                    del self.__cursors[name]
+
+
+    def __cursorValid(self, fullname):
+        """false if the thing was deleted or removed, listings do not
+        find things before it anymore. One small api request.
+        """
+        things = list(self.r.info(fullnames=[fullname]))
+        if not things:
+            return False
+
+        thing = vars(things[0])
+        return thing.get('author') is not None \
+                and not thing.get('removed_by_category') \
+                and thing.get('body') not in ('[deleted]', '[removed]')
+
+
     def __connect(self):
 
         connectTry = 1
@@ -184,7 +668,9 @@ class RedditBot:
         while True:
             try:
                 log.debug("connect() creating reddit adapter")
-                self.r = praw.Reddit(self.iniSite)
+                self.r = praw.Reddit(self.iniSite,
+                        requestor_class=_LimitedRequestor,
+                        requestor_kwargs={'limiter': self.limiter})
 
                 # connect and check if instance has required scopes
                 for scope in self.scopes:
@@ -213,11 +699,8 @@ class RedditBot:
 
 
 
-    def run(self, postRoundAction):
-        """Run the bot forever (until 'lockfile.lock' is deleted).
-
-        :param postRoundAction: function() to be called before sleep
-        """
+    def __start(self):
+        """connect, open db and create lockfile"""
         log.basicConfig(format='%(asctime)s %(levelname)s %(name)s %(message)s',
                         level=log.DEBUG)
 
@@ -225,89 +708,241 @@ class RedditBot:
         self.__connect()
 
         # connecting to seen db
-        self.__seenDB = _SeenDB(self.dbName)
-
-        # wrap around doing stuff
-        def do(things, listener):
-            for thing in things:
-                if self.killed or self.__seenDB.isSeen(thing):
-                    return
-                if (isinstance(thing, praw.models.Submission) or thing.author != self.me) \
-                        and thing.author not in self.userBlacklist:
-                    listener(self.r, thing)
+        self.__ownStorage = self.storage is None
+        if self.__ownStorage:
+            self.storage = Storage(self.dbName)
+        self.__seenDB = _SeenDB(storage=self.storage)
+        self.__outbox = _Outbox(storage=self.storage)
+        self.retention.add(self.__seenDB, self.SEEN_AGE)
+        self.retention.add(self.__outbox, self.SEEN_AGE)
 
         # create lockfile for clean shutdown, delete the file to stop bot
         with open(self.LOCK_FILE, 'w'): pass
 
         # count consecutive fails
-        failCount = 0
+        self.__failCount = 0
+
+
+    def __close(self):
+        self.__seenDB.close()
+        self.__outbox.close()
+        if self.__ownStorage:
+            self.storage.close()
+        else:
+            self.storage.commit()
+
+
+    def __running(self):
+        return os.path.isfile(self.LOCK_FILE) and not self.killed
+
+
+    def __do(self, things, listener, skipSeen=False):
+        """wrap around doing stuff, stops at the first seen thing
+        or skips seen things. Skipped things are only seen once their
+        listener succeeded.
+        """
+        for thing in things:
+            if self.killed:
+                return
+            with self.metrics.timer('seen'):
+                seen = self.__seenDB.isSeen(thing)
+            if seen:
+                if skipSeen:
+                    continue
+                return
+
+            self.metrics.count('new')
+            if (isinstance(thing, praw.models.Submission) or thing.author != self.me) \
+                    and thing.author not in self.userBlacklist:
+                try:
+                    self.__listen(listener, thing)
+                except Exception:
+                    if skipSeen:
+                        self.__seenDB.forget(thing)
+                    raise
+            else:
+                self.metrics.count('skipped')
+
+
+    def __listen(self, listener, thing):
+        with self.metrics.timer('listener'):
+            listener(self.r, thing)
+
+
+    def __guarded(self, action):
+        """call action, handle reddit errors
+
+        :return: true if successful
+        """
+        try:
+            action()
+            # success, reset fails
+            self.__failCount = 0
+            return True
+
+        except praw.exceptions.APIException as e:
+            # https://github.com/reddit/reddit/blob/master/r2/r2/lib/errors.py
+            if 'RATELIMIT' in e.error_type:
+                # only writes wait, reading goes on
+                reset = self.r.auth.limits.get('reset_timestamp')
+                default = reset - _now() + 5 if reset else 60
+                seconds = _rateLimitSeconds(e.message, default)
+                self.limiter.pauseWrites(seconds)
+
+                log.warn('run() rate exceeded, pausing writes %s', seconds)
+            else:
+                log.exception('run() reddit responded with error: %s', e)
+
+        except RateLimited as e:
+            # quota used up or killed while waiting, next round tries again
+            log.warning('run() %s', e)
+
+        except prawcore.exceptions.PrawcoreException:
+            # connection errors if bot or reddit is offline
+            log.exception('run() error in core while redditing')
+            self.__failCount += 1
+
+            if self.__failCount >= self.__failLimit:
+                # some error/python version/praw version combinations never recover
+                log.error('run() consecutive fails reached limit, leaving to restart')
+                self.killed = True
+
+        except KeyboardInterrupt:
+            log.warn('run() interrupt, leaving')
+            self.killed = True
+
+        return False
+
+
+    def reply(self, thing, body):
+        """Queue a reply to a thing, it is sent after the listeners of the
+        round with retries. Queued replies survive restarts.
+
+        :return: false if the thing already has a reply
+        """
+        return self.__outbox.put(thing.fullname, body)
+
+
+    def __send(self, fullname, body, attempts, results):
+        """send one reply, results get (kind, fullname, attempts)"""
+        try:
+            with self.metrics.timer('reply'):
+                self.r.post(API_PATH['comment'],
+                        data={'text': body, 'thing_id': fullname})
+            results.append(('sent', fullname, attempts))
+
+        except RateLimited:
+            # writes were paused meanwhile
+            results.append(('postponed', fullname, attempts))
+
+        except prawcore.exceptions.PrawcoreException:
+            log.exception('send() failed to reply to %s', fullname)
+            results.append(('failed', fullname, attempts))
+
+        except praw.exceptions.APIException as e:
+            if e.error_type in self.REPLY_DROP_ERRORS:
+                log.warning('send() dropping reply to %s: %s', fullname, e)
+                results.append(('dropped', fullname, attempts))
+                return
+
+            if 'RATELIMIT' in e.error_type:
+                seconds = _rateLimitSeconds(e.message, 60)
+                self.limiter.pauseWrites(seconds)
+                log.warn('send() rate exceeded, pausing writes %s', seconds)
+            else:
+                log.exception('send() reddit responded with error: %s', e)
+            results.append(('failed', fullname, attempts))
+
+
+    def __sendReplies(self):
+        """send due replies of the outbox, while writes are paused
+        they are postponed instead
+        """
+        due = self.__outbox.due(self.OUTBOX_BATCH)
+        paused = self.limiter.writesPausedFor()
+        if due and paused:
+            log.debug('sendReplies() writes paused, postponing %s replies', len(due))
+            self.__outbox.postpone([fullname for fullname, _, _ in due], paused)
+            return
+
+        results = []
+        for i, (fullname, body, attempts) in enumerate(due):
+            if self.killed:
+                break
+            self.__send(fullname, body, attempts, results)
+            if results[-1][0] == 'postponed':
+                # writes were paused meanwhile, the rest waits too
+                results.extend(('postponed', f, a) for f, _, a in due[i + 1:])
+                break
+
+        for kind, _, _ in results:
+            self.metrics.count('replies_' + kind)
+
+        postponed = [f for kind, f, _ in results if kind == 'postponed']
+        if postponed:
+            self.__outbox.postpone(postponed, max(self.limiter.writesPausedFor(), 1))
+
+        if results:
+            self.__outbox.update(
+                    sent=[f for kind, f, _ in results if kind == 'sent'],
+                    failed=[(f, a) for kind, f, a in results if kind == 'failed'],
+                    dropped=[f for kind, f, _ in results if kind == 'dropped'])
+
+
+    def __postRound(self, postRoundAction):
+        # post round actions
+        if not self.killed:
+            with self.metrics.timer('post_action'):
+                postRoundAction()
+            self.__sendReplies()
+            with self.metrics.timer('cleanup'):
+                self.retention.run()
+
+        if self.metricsFile:
+            self.metrics.dump(self.metricsFile)
+
+
+    def run(self, postRoundAction):
+        """Run the bot forever (until 'lockfile.lock' is deleted).
+
+        :param postRoundAction: function() to be called before sleep
+        """
+        self.__start()
+
+        def doRound():
+            if self.__submissionListener:
+                subreddit = self.r.subreddit(self.__subreddits)
+                self.__do(self.__listing('submissions', subreddit.new),
+                        self.__submissionListener)
+                self.__advance('submissions')
+
+            if self.__commentListener and not self.killed:
+                subreddit = self.r.subreddit(self.__subreddits)
+                self.__do(self.__listing('comments', subreddit.comments),
+                        self.__commentListener)
+                self.__advance('comments')
+
+            if (self.__pmListener or self.__mentionListener) and not self.killed:
+                items = list(self.r.inbox.unread(limit=self.newLimit))
+                self.metrics.count('fetched', len(items))
+                self.__doInbox(items)
+
+            self.__postRound(postRoundAction)
 
         # main loop
-        while os.path.isfile(self.LOCK_FILE) and not self.killed:
+        while self.__running():
             self.roundStart = _now()
+            # cursors of failed rounds are not moved
+            self.__newest.clear()
 
-            try:
-                if self.__submissionListener:
-                    subreddit = self.r.subreddit(self.__subreddits)
-                    do(subreddit.new(limit=self.newLimit),
-                            self.__submissionListener)
-
-                if self.__commentListener and not self.killed:
-                    subreddit = self.r.subreddit(self.__subreddits)
-                    do(subreddit.comments(limit=self.newLimit),
-                            self.__commentListener)
-
-                if (self.__pmListener or self.__mentionListener) and not self.killed:
-                    items = list(self.r.inbox.unread(mark_read=True,
-                            limit=self.newLimit))
-
-                    for someitems in _partition(items, 100):
-                        self.r.inbox.mark_read(someitems)
-
-                    # pm
-                    if self.__pmListener:
-                        do((item for item in items if isinstance(item, Message)),
-                                self.__pmListener)
-                    # mention
-                    if self.__mentionListener:
-                        for item in items:
-                            if isinstance(item, Comment):
-                                if item.subject == "username mention":
-                                    do([item], self.__mentionListener)
-
-                # post round actions
-                if not self.killed:
-                    postRoundAction()
-                    self.__seenDB.cleanup()
-
-                # success, reset fails
-                failCount = 0
-
-            except praw.exceptions.APIException as e:
-                # https://github.com/reddit/reddit/blob/master/r2/r2/lib/errors.py
-                if 'RATELIMIT' in e.error_type:
-                    reset = self.r.auth.limits.get('reset_timestamp')
-                    if reset:
-                        self.rateSleep = reset - _now() + 5
-
-                    log.warn('run() rate exceeded, going to sleep %s',
-                             self.rateSleep)
-                else:
-                    log.exception('run() reddit responded with error: %s', e)
-
-            except prawcore.exceptions.PrawcoreException:
-                # connection errors if bot or reddit is offline
-                log.exception('run() error in core while redditing')
-                failCount += 1
-
-                if failCount >= self.__failLimit:
-                    # some error/python version/praw version combinations never recover
-                    log.error('run() consecutive fails reached limit, leaving to restart')
-                    self.killed = True
-
-            except KeyboardInterrupt:
-                log.warn('run() interrupt, leaving')
-                self.killed = True
+            with self.metrics.timer('round'):
+                self.__guarded(doRound)
+            self.metrics.count('rounds')
+
+            # remember things of this round, even after errors
+            self.__seenDB.flush()
+            self.storage.commit()
+            self.rounds += 1
 
             # sleep before next round/attempt
             if not self.killed:
@@ -316,25 +951,118 @@ class RedditBot:
 
         # lock file is gone or killed
         log.warning('run() leaving reddit-bot')
-        self.__seenDB.close()
+        self.__close()
+
 
+    def __streams(self):
+        """new praw streams, they yield None after every request"""
+        streams = []
+        subreddit = self.r.subreddit(self.__subreddits)
+
+        if self.__submissionListener:
+            streams.append((subreddit.stream.submissions(pause_after=-1),
+                    self.__submissionListener))
+        if self.__commentListener:
+            streams.append((subreddit.stream.comments(pause_after=-1),
+                    self.__commentListener))
+        if self.__pmListener or self.__mentionListener:
+            streams.append((self.r.inbox.stream(pause_after=-1), None))
+
+        return streams
+
+
+    def __doInbox(self, items):
+        """Give unread inbox things to the listener of their category,
+        mark all read once the listeners are done. A failed listener leaves
+        all things unread, its thing is given to the listener again next
+        round, the others are skipped as seen.
+        """
+        pms = []
+        mentions = []
+        for item in items:
+            if isinstance(item, Message):
+                pms.append(item)
+            elif isinstance(item, Comment) and item.subject == "username mention":
+                mentions.append(item)
 
-def _partition(sequence, chunksize):
-    """break a long iterable down into smaller lists"""
-    result = []
-    another = None
-    second = False
+        if self.__pmListener:
+            self.__do(pms, self.__pmListener, skipSeen=True)
+        if self.__mentionListener:
+            self.__do(mentions, self.__mentionListener, skipSeen=True)
 
-    for item in sequence:
-        if second:
-            result.append(another)
-            if len(result) >= chunksize:
-                yield result
-                result = []
-        another = item
-        second = True
+        for i in range(0, len(items), self.MARK_READ_BATCH):
+            self.r.inbox.mark_read(items[i:i + self.MARK_READ_BATCH])
 
-    if second:
-        result.append(another)
 
-    yield result
+    def stream(self, postRoundAction):
+        """Run the bot forever like run(), but read continuous streams
+        instead of rounds. The bot pauses between STREAM_MIN_PAUSE and
+        sleep seconds, shorter while busy, longer while idle.
+
+        :param postRoundAction: function() to be called every sleep seconds
+        """
+        self.__start()
+
+        streams = []
+        pause = self.STREAM_MIN_PAUSE
+        nextPostRound = _now() + self.sleep
+
+        while self.__running():
+            self.roundStart = _now()
+            found = 0
+
+            def doStreams():
+                nonlocal found, streams, nextPostRound
+
+                if not streams:
+                    streams = self.__streams()
+
+                inbox = []
+                for things, listener in streams:
+                    for i, thing in enumerate(things):
+                        if thing is None or self.killed:
+                            break
+                        found += 1
+                        self.metrics.count('fetched')
+                        if listener:
+                            self.__do([thing], listener)
+                        else:
+                            inbox.append(thing)
+                        # a busy stream must not starve the others
+                        if i + 1 >= self.STREAM_BATCH:
+                            break
+
+                if inbox:
+                    self.__doInbox(inbox)
+
+                self.__sendReplies()
+
+                if _now() >= nextPostRound:
+                    nextPostRound = _now() + self.sleep
+                    self.__postRound(postRoundAction)
+
+            with self.metrics.timer('round'):
+                success = self.__guarded(doStreams)
+            self.metrics.count('rounds')
+
+            if not success:
+                # a failed stream is done, start new ones
+                streams = []
+
+            # remember things of this round, even after errors
+            self.__seenDB.flush()
+            self.storage.commit()
+            self.rounds += 1
+
+            # busy: read again soon, idle: wait longer
+            if found:
+                pause = self.STREAM_MIN_PAUSE
+            else:
+                pause = min(pause * 2, self.sleep)
+
+            if not self.killed:
+                self.__pause(pause)
+
+        # lock file is gone or killed
+        log.warning('stream() leaving reddit-bot')
+        self.__close()
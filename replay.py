@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+"""Replay recorded reddit things through the answer pipeline, no reddit required.
+python3 replay.py [corpus.jsonl]
+python3 replay.py --generate corpus.jsonl [count]
+
+One JSON object per line:
+{"kind": "comment|mention|submission|pm", "id": "abc", "author": "user",
+ "body": "text", "title": "submission title", "subject": "pm subject",
+ "parent_id": "t1_xyz"}
+Without corpus a generated one with typos and duplicates is used.
+"""
+
+import json
+import random
+import sys
+import time
+import tracemalloc
+
+from benchmark import typo
+from cardDB import CardDB
+from constants import Constants
+from helper import HSHelper
+import commentDB
+
+hsbot = __import__('hearthscan-bot')
+
+
+# things handled between two sendRoundAnswers
+ROUND_SIZE = 25
+PREFIXES = {'comment': 't1_', 'mention': 't1_', 'submission': 't3_', 'pm': 't4_'}
+
+
+class FakeRedditor():
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return self.name
+
+    def message(self, subject, body):
+        pass
+
+
+class FakeThing():
+    """comment, submission or message with the attributes the bot reads"""
+
+    def __init__(self, record):
+        kind = record['kind']
+        self.kind = kind
+        self.id = record['id']
+        self.fullname = PREFIXES[kind] + self.id
+        self.author = FakeRedditor(record.get('author', 'user'))
+        self.body = record.get('body', '')
+        self.title = record.get('title', '')
+        self.selftext = self.body
+        self.is_self = True
+        self.subject = record.get('subject',
+                'username mention' if kind == 'mention' else '')
+        self.parent_id = record.get('parent_id', 't3_' + self.id)
+        self.link_id = self.parent_id
+        self.subreddit = None if kind == 'pm' else FakeSubreddit()
+        self.submission = self
+        self.distinguished = None
+        self.replies = []
+
+    def reply(self, text):
+        self.replies.append(text)
+
+
+class FakeSubreddit():
+    display_name = 'hearthstone'
+
+    def __str__(self):
+        return self.display_name
+
+
+class FakeInbox():
+    def message(self, id):
+        return None
+
+
+class FakeReddit():
+    """the parts of praw.Reddit the listeners use"""
+
+    def __init__(self):
+        self.inbox = FakeInbox()
+
+    def redditor(self, name):
+        return FakeRedditor(name)
+
+    def comment(self, id):
+        return None
+
+
+def generate(cardDB, count, seed=42):
+    """records of comments, mentions, submissions and pms requesting
+    random cards, some with typos, some duplicates of the same parent
+    """
+    rnd = random.Random(seed)
+    names = sorted(name for name in cardDB.cardNames() if len(name) > 3)
+    kinds = ['comment'] * 7 + ['mention', 'submission', 'pm']
+    records = []
+
+    for i in range(count):
+        cards = []
+        for _ in range(rnd.choice((0, 1, 1, 2, 3))):
+            name = rnd.choice(names)
+            cards.append('[[{}]]'.format(typo(name, 1, rnd)
+                    if rnd.random() < 0.2 else name))
+
+        records.append({
+            'kind': rnd.choice(kinds),
+            'id': 'r{}'.format(i),
+            'author': 'user{}'.format(rnd.randrange(count // 4 + 1)),
+            'body': 'I think {} is good'.format(' and '.join(cards)),
+            'title': 'a title',
+            'subject': 'a subject',
+            'parent_id': 't3_p{}'.format(rnd.randrange(count // 10 + 1))
+        })
+
+    return records
+
+
+def loadCorpus(fileName):
+    with open(fileName, 'r', encoding='utf8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def replay(records, cardDB, constants):
+    """:return: dict of kind to list of seconds per thing"""
+    helper = HSHelper(cardDB, constants)
+    answeredDB = commentDB.DB(':memory:')
+    r = FakeReddit()
+    pmUserCache = {}
+    roundAnswers = []
+    times = {}
+
+    def sendRound():
+        start = time.perf_counter()
+        hsbot.sendRoundAnswers(roundAnswers, answeredDB)
+        hsbot.cleanPMUserCache(pmUserCache)
+        times.setdefault('round', []).append(time.perf_counter() - start)
+
+    for i, record in enumerate(records):
+        thing = FakeThing(record)
+        start = time.perf_counter()
+
+        if thing.kind == 'comment':
+            hsbot.answerComment(r, thing, roundAnswers, helper)
+        elif thing.kind == 'mention':
+            hsbot.answerMention(r, thing, roundAnswers, helper)
+        elif thing.kind == 'submission':
+            hsbot.answerSubmission(thing, helper)
+        else:
+            hsbot.answerPM(r, thing, pmUserCache, helper)
+
+        times.setdefault(thing.kind, []).append(time.perf_counter() - start)
+
+        if (i + 1) % ROUND_SIZE == 0:
+            sendRound()
+
+    sendRound()
+    answeredDB.close()
+    return times
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[int(p * (len(values) - 1))]
+
+
+def report(records, times, took):
+    print('{} things in {:.2f} s, {:.0f} things/s'.format(
+            len(records), took, len(records) / took))
+    print('{:<12} {:>8} {:>10} {:>10}'.format('kind', 'count', 'p50 us', 'p99 us'))
+    for kind, values in sorted(times.items()):
+        print('{:<12} {:>8} {:>10.1f} {:>10.1f}'.format(kind, len(values),
+                percentile(values, 0.5) * 1e6, percentile(values, 0.99) * 1e6))
+
+
+def main():
+    constants = Constants()
+    cardDB = CardDB(constants=constants, snapshotFile='data/cards.snapshot')
+
+    if sys.argv[1:2] == ['--generate']:
+        count = int(sys.argv[3]) if len(sys.argv) > 3 else 10000
+        with open(sys.argv[2], 'w', encoding='utf8', newline='\n') as f:
+            for record in generate(cardDB, count):
+                f.write(json.dumps(record) + '\n')
+        return
+
+    records = loadCorpus(sys.argv[1]) if len(sys.argv) > 1 \
+            else generate(cardDB, 10000)
+
+    start = time.perf_counter()
+    times = replay(records, cardDB, constants)
+    report(records, times, time.perf_counter() - start)
+
+    # second run, tracing allocations is slow
+    tracemalloc.start()
+    replay(records, cardDB, constants)
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print('allocations: {:.1f} MB peak, {:.1f} MB still allocated'.format(
+            peak / 2**20, current / 2**20))
+    for stat in snapshot.statistics('lineno')[:5]:
+        print('  ', stat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,94 @@
+
+import logging as log
+import time
+
+
+def enableIncrementalVacuum(storage, schema='main'):
+    """switch a db file of the storage to incremental auto vacuum,
+    an existing file is rebuilt once
+    """
+    with storage.lock:
+        if storage.conn.execute('PRAGMA {}.auto_vacuum'.format(schema)).fetchone()[0] != 2:
+            log.info('enableIncrementalVacuum() rebuilding %s %s', storage, schema)
+            # vacuum is not possible in a transaction
+            storage.commit()
+            storage.conn.execute('PRAGMA {}.auto_vacuum=INCREMENTAL'.format(schema))
+            storage.conn.execute('VACUUM {}'.format(schema))
+
+
+def pruneBatch(storage, table, timestamp, limit=None, where='', schema='main'):
+    """delete rows created before timestamp, oldest first
+
+    :param limit: max rows to delete, all if None
+    :param where: additional condition
+    :return: number of deleted rows
+    """
+    condition = 'created <= ?' + (' AND ' + where if where else '')
+    table = schema + '.' + table
+
+    if limit is None:
+        query = 'DELETE FROM {} WHERE {}'.format(table, condition)
+        params = (timestamp, )
+    else:
+        query = ('DELETE FROM {0} WHERE rowid IN (SELECT rowid FROM {0}'
+                    ' WHERE {1} ORDER BY created LIMIT ?)').format(table, condition)
+        params = (timestamp, limit)
+
+    with storage.write() as conn:
+        return conn.execute(query, params).rowcount
+
+
+def vacuum(storage, pages, schema='main'):
+    """give up to n free pages back to the file system"""
+    with storage.lock:
+        storage.conn.execute('PRAGMA {}.incremental_vacuum({})'.format(
+                schema, int(pages))).fetchall()
+
+
+class Retention():
+    """Prunes old rows of stores in small batches on a schedule and runs
+    incremental vacuum now and then. A store has prune(secondsOld, limit)
+    returning the number of deleted rows and vacuum(pages).
+    Call run() every round, it does at most one batch per store.
+    """
+
+    def __init__(self, interval=10 * 60, batchSize=500,
+            vacuumInterval=6 * 60 * 60, vacuumPages=1000):
+        """
+        :param interval: prune every n seconds
+        :param batchSize: rows deleted per store and round
+        :param vacuumInterval: vacuum every n seconds
+        :param vacuumPages: pages freed per store and vacuum
+        """
+        self.interval = interval
+        self.batchSize = batchSize
+        self.vacuumInterval = vacuumInterval
+        self.vacuumPages = vacuumPages
+        # store, secondsOld, more rows to delete
+        self.__stores = []
+        self.__nextPrune = 0
+        self.__nextVacuum = time.time() + vacuumInterval
+
+    def add(self, store, secondsOld):
+        """prune rows of store older than n seconds"""
+        self.__stores.append([store, secondsOld, False])
+
+    def run(self):
+        now = time.time()
+        due = now >= self.__nextPrune
+        if due:
+            self.__nextPrune = now + self.interval
+
+        for entry in self.__stores:
+            store, secondsOld, behind = entry
+            if due or behind:
+                deleted = store.prune(secondsOld, self.batchSize)
+                # a full batch, continue next round
+                entry[2] = deleted >= self.batchSize
+                if deleted:
+                    log.debug('run() pruned %s rows of %s', deleted, store)
+
+        if now >= self.__nextVacuum:
+            self.__nextVacuum = now + self.vacuumInterval
+            for store, _, _ in self.__stores:
+                store.vacuum(self.vacuumPages)
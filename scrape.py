@@ -1,17 +1,23 @@
 #!/usr/bin/env python3
 
+import hashlib
 import json
 import logging as log
 import os
 import os.path
 import re
 import sys
+import threading
 import time
-from multiprocessing.dummy import Pool
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
 
 from lxml.html import fromstring
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 
+from cardDB import CardDB
 from constants import Constants
 
 
@@ -27,88 +33,12 @@ This is especially true when using images.
 setUrlTempl = ('https://www.hearthpwn.com/cards?'
                'filter-name={}&filter-premium={}&filter-type={}&filter-set={}'
                '&filter-unreleased=1&display=2')
-# hearthstonejson set id to card_constant set id
-jsonToCCSet = {
-    'EXPERT1': '02',
-    'NAXX': '05',
-    'GVG': '06',
-    'BRM': '07',
-    'TGT': '08',
-    'LOE': '09',
-    'OG': '10',
-    'KARA': '11',
-    'GANGS': '12',
-    'UNGORO': '13',
-    'ICECROWN': '15',
-    'LOOTAPALOOZA': '16',
-    'GILNEAS': '17',
-    'BOOMSDAY': '18',
-    'TROLL': '19',
-    'DALARAN': '20',
-    'ULDUM': '21',
-    'DRAGONS': '22',
-    'YEAR_OF_THE_DRAGON': '23',
-    'DEMON_HUNTER_INITIATE': '24',
-    'BLACK_TEMPLE': '25',
-    'SCHOLOMANCE': '26',
-    'DARKMOON_FAIRE': '27',
-    'TB': '28',
-    'CORE': '29',
-    'THE_BARRENS': '30',
-    'VANILLA': '31',
-    'TAVERNS_OF_TIME': '32', # arena event tokens
-    'LEGACY': '33',
-    #'BATTLEGROUNDS': '34'
-    'STORMWIND': '35',
-    'ALTERAC_VALLEY': '36',
-    'THE_SUNKEN_CITY': '37',
-    'REVENDRETH': '38',
-    'RETURN_OF_THE_LICH_KING': '39',
-    'BATTLE_OF_THE_BANDS': '40',
-    'PATH_OF_ARTHAS': '41'
-}
+cc = Constants()
+# hearthstonejson set id to card_constant set id, a new set is added to constants.json
+jsonToCCSet = dict((s['json'], ccid) for ccid, s in cc.sets.items() if 'json' in s)
 # card_constant set ids to hs internal set ids
-setids = {
-    '02' : 3,
-    '05' : 100,
-    '06' : 101,
-    '07' : 102,
-    '08' : 103,
-    '09' : 104,
-    '10' : 105,
-    '11' : 106,
-    '12' : 107,
-    '13' : 108,
-    '15' : 109,
-    '16' : 110,
-    '17' : 111,
-    '18' : 113,
-    '19' : 114,
-    '20' : 115,
-    '21' : 116,
-    '22' : 1200,
-    '23' : 1300,
-    '24' : 1500,
-    '25' : 1400,
-    '26': 1443,
-    '27': 1600,
-    '28': 1601,
-    '29': 1800,
-    '30': 1700,
-    '31': 2000,
-    '32': 112,
-    '33': 1900,
-    #'34': 1117,
-    '35': 2100,
-    '36': 1626,
-    '37': 2300,
-    '38': 2500,
-    '39': 2600,
-    '40': 2700,
-    '41': 2550
-}
+setids = dict((ccid, s['hsid']) for ccid, s in cc.sets.items() if 'hsid' in s)
 # set names to hs internal set ids
-cc = Constants()
 setNameIds = dict((cc.sets[ccid]['name'], hsid) for ccid, hsid in setids.items())
 # duel cards
 duelSetIds = [ ccid for ccid in setids if cc.sets[ccid].get("duels") ]
@@ -139,6 +69,222 @@ bad_cards = [
     "PVPDR_BAR_Passive12",
     "PVPDR_BAR_Passive13",
 ]
+# cards and tokens scraped at once over all sets
+SCRAPE_WORKERS = 8
+# requests at once and seconds between requests per host
+HOST_CONNECTIONS = 2
+HOST_INTERVAL = 0.2
+# finished cards of an interrupted scrape
+JOURNAL_FILE = 'data/scrape.journal'
+# responses of all fetchers, revalidated after the ttl in seconds
+CACHE_DIR = 'data/http-cache'
+CACHE_TTL = 30 * 24 * 60 * 60
+# search and listing pages change with every new card
+CACHE_LISTING_TTL = 60 * 60
+# card detail pages, only these are kept for the long ttl
+cacheDetailUrls = re.compile(r'https://www\.hearthpwn\.com/cards/\d+'
+                             r'|https://www\.hearthstonetopdecks\.com/cards/[^/?]+/')
+
+
+class HTTPCache():
+    """Responses on disk, one file per url and params.
+    Fresh responses are used without a request, stale ones are
+    revalidated with ETag and Last-Modified. Card detail pages are fresh
+    for ttl, search and listing pages for listingTtl seconds.
+    Offline only the cache is used, missing urls fail.
+    """
+
+    def __init__(self, directory=CACHE_DIR, ttl=CACHE_TTL,
+            listingTtl=CACHE_LISTING_TTL, offline=False):
+        self.directory = directory
+        self.ttl = ttl
+        self.listingTtl = listingTtl
+        self.offline = offline
+
+    def ttlFor(self, url, params=None):
+        if not params and cacheDetailUrls.fullmatch(url):
+            return self.ttl
+        return self.listingTtl
+
+    def __path(self, url, params):
+        query = urllib.parse.urlencode(sorted((params or {}).items()))
+        key = hashlib.sha256((url + '?' + query).encode('utf8')).hexdigest()
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, url, fetch, params=None):
+        """cached response or the response of fetch(url, params=, headers=)"""
+        path = self.__path(url, params)
+        entry = None
+        if os.path.isfile(path):
+            with open(path, 'r', encoding='utf8') as f:
+                entry = json.load(f)
+
+        if entry and (self.offline or
+                time.time() - entry['fetched'] < self.ttlFor(url, params)):
+            return self.__response(entry)
+        if self.offline:
+            raise requests.ConnectionError('HTTPCache() offline and not cached: ' + url)
+
+        headers = {}
+        if entry and entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry and entry.get('lastModified'):
+            headers['If-Modified-Since'] = entry['lastModified']
+
+        r = fetch(url, params=params, headers=headers)
+        if entry and r.status_code == 304:
+            log.debug("get() not modified %s", url)
+            entry['fetched'] = time.time()
+            self.__save(path, entry)
+            return self.__response(entry)
+
+        if r.status_code == 200:
+            self.__save(path, {
+                'url': r.url,
+                'fetched': time.time(),
+                'etag': r.headers.get('ETag'),
+                'lastModified': r.headers.get('Last-Modified'),
+                'contentType': r.headers.get('Content-Type'),
+                'text': r.text
+            })
+        return r
+
+    def __save(self, path, entry):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmpFile = '{}.{}.tmp'.format(path, threading.get_ident())
+        with open(tmpFile, 'w', encoding='utf8', newline='\n') as f:
+            json.dump(entry, f)
+        os.replace(tmpFile, path)
+
+    def __response(self, entry):
+        r = requests.Response()
+        r.status_code = 200
+        r.url = entry['url']
+        r.encoding = 'utf8'
+        r._content = entry['text'].encode('utf8')
+        r.headers = CaseInsensitiveDict({'Content-Type': entry.get('contentType') or ''})
+        return r
+
+
+# shared by all sessions of the scrape
+httpCache = HTTPCache()
+
+
+class PoliteSession():
+    """One pooled requests session shared by all workers.
+    Limits requests at once and the request rate per host.
+    Responses are read from and stored in the optional cache.
+    """
+
+    def __init__(self, connections=HOST_CONNECTIONS, interval=HOST_INTERVAL,
+            cache=None):
+        self.connections = connections
+        self.interval = interval
+        self.cache = cache if cache is not None else httpCache
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=SCRAPE_WORKERS)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.__lock = threading.Lock()
+        # host to [semaphore, time of next request]
+        self.__hosts = {}
+
+    def get(self, url, params=None, **kwargs):
+        if self.cache:
+            return self.cache.get(url, lambda url, params, headers:
+                    self.__get(url, params=params, headers=headers, **kwargs), params)
+        return self.__get(url, params=params, **kwargs)
+
+    def __get(self, url, **kwargs):
+        host = urllib.parse.urlsplit(url).netloc
+        with self.__lock:
+            slot = self.__hosts.setdefault(host,
+                    [threading.Semaphore(self.connections), 0])
+
+        with slot[0]:
+            with self.__lock:
+                now = time.monotonic()
+                wait = slot[1] - now
+                slot[1] = max(now, slot[1]) + self.interval
+            if wait > 0:
+                time.sleep(wait)
+            return self.session.get(url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+class Journal():
+    """Checkpoint of finished work, one json line per result.
+    An interrupted scrape resumes with the missing work.
+    """
+
+    def __init__(self, fileName=JOURNAL_FILE):
+        self.fileName = fileName
+        self.__lock = threading.Lock()
+        self.__done = {}
+
+        if os.path.isfile(fileName):
+            complete = 0
+            lastLine = b''
+            with open(fileName, 'rb') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # last line cut off by the interrupt
+                        break
+                    self.__done[entry['key']] = entry['value']
+                    complete += len(line)
+                    lastLine = line
+
+            # new results must not be appended to a cut off line
+            with open(fileName, 'r+b') as f:
+                f.truncate(complete)
+                if lastLine and not lastLine.endswith(b'\n'):
+                    f.seek(complete)
+                    f.write(b'\n')
+            log.debug("Journal() resuming with %s results", len(self.__done))
+
+        self.__file = open(fileName, 'a', encoding='utf8', newline='\n')
+
+    def get(self, key):
+        with self.__lock:
+            return self.__done.get(key)
+
+    def put(self, key, value):
+        with self.__lock:
+            self.__done[key] = value
+            self.__file.write(json.dumps({'key': key, 'value': value}) + '\n')
+            self.__file.flush()
+
+    def close(self, finished=False):
+        """:param finished: all work is saved, forget the journal"""
+        self.__file.close()
+        if finished:
+            os.remove(self.fileName)
+
+
+def runAll(work, workers=SCRAPE_WORKERS):
+    """call all functions in a thread pool
+
+    :return: list of (result, exception) in order of work
+    """
+    def call(fn):
+        try:
+            return fn(), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(workers) as pool:
+        return list(pool.map(call, work))
 
 
 def getHTDId(name, *ignored):
@@ -192,10 +338,14 @@ def camelCase(s):
     return " ".join(part[:1].upper() + part[1:].lower() for part in parts) if parts else None
 
 
+tagRegex = re.compile(r"</?\w+>")
+spacesRegex = re.compile(r"[ ]{2,}")
+
 def fixText(text):
     if text:
         # replace xml tags
-        text = re.sub(r"</?\w+>", '', text)
+        if '<' in text:
+            text = tagRegex.sub('', text)
         # copy bold/italic to reddit?
         # text = re.sub(r"</?b+>", '**', text)
         # text = re.sub(r"</?i+>", '*', text)
@@ -207,127 +357,229 @@ def fixText(text):
                     .replace('\u00A0', ' ') \
                     .replace('#', '')
         # replace multiple spaces
-        text = re.sub(r"[ ]{2,}", ' ', text)
+        if '  ' in text:
+            text = spacesRegex.sub(' ', text)
         text = text.strip()
 
     return text
 
 
-def getCardJson():
+jsonSeparatorRegex = re.compile(r"[\s,]*")
+
+def iterJsonArray(f, chunkSize=1 << 16):
+    """yield the elements of a json array file one by one,
+    only one chunk of the file is in memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = f.read(chunkSize).lstrip()
+    if not buffer.startswith('['):
+        raise ValueError('iterJsonArray() no json array')
+    pos = 1
+
+    while True:
+        pos = jsonSeparatorRegex.match(buffer, pos).end()
+        if buffer.startswith(']', pos):
+            return
+        try:
+            element, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # element cut off at the end of the chunk
+            chunk = f.read(chunkSize)
+            if not chunk:
+                raise
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+        yield element
+
+
+def getCardJson(keep=None):
+    """yield the cards of hearthstonejson, if keep(card) is true"""
     rawJson = 'raw-cards.json'
-    if not os.path.isfile(rawJson) or os.path.getmtime(rawJson) < (time.time() - 24*60*60):
-        with open(rawJson, 'wb') as f:
-            f.write(requests.get('https://api.hearthstonejson.com/v1/latest/enUS/cards.json').content)
+    if httpCache.offline:
+        if not os.path.isfile(rawJson):
+            raise requests.ConnectionError('getCardJson() offline and missing: ' + rawJson)
+    elif not os.path.isfile(rawJson) or os.path.getmtime(rawJson) < (time.time() - 24*60*60):
+        with requests.get('https://api.hearthstonejson.com/v1/latest/enUS/cards.json', stream=True) as r:
+            r.raise_for_status()
+            with open(rawJson + '.tmp', 'wb') as f:
+                for chunk in r.iter_content(1 << 16):
+                    f.write(chunk)
+        os.replace(rawJson + '.tmp', rawJson)
 
     with open(rawJson, encoding='utf8') as f:
-        return json.load(f)
+        for card in iterJsonArray(f):
+            if keep is None or keep(card):
+                yield card
+
+
+# a card is dropped when all conditions of a rule match
+# condition operators: in, notIn, prefix, contains, empty
+# cards of sets missing in constants.json are dropped by knownSet() while parsing
+cardFilterRules = [
+    # not a real card set
+    ('hero skins', {'set': {'in': ['HERO_SKINS']}}),
+    # buffs are irrelevant for us
+    ('buffs', {'type': {'notIn': ['MINION', 'SPELL', 'WEAPON', 'HERO', 'HERO_POWER', 'LOCATION']}}),
+    # skip default and duels heroes
+    ('default heroes', {'set': {'in': ['BASIC', 'CORE', 'VANILLA'] + duelSets},
+                        'type': {'in': ['HERO', 'HERO_POWER']}}),
+    # skip tavern brawl cards not used in duels
+    ('brawl cards', {'set': {'in': duelSets}, 'id': {'notPrefix': ['PVPDR']}}),
+    # skip dummy fx
+    ('dummy fx', {'id': {'contains': ['DFX']}}),
+    # skip upgraded battleground cards
+    ('upgraded battlegrounds', {'set': {'in': ['BATTLEGROUNDS']}, 'techLevel': {'empty': True}}),
+    # skip duels buckets
+    ('duels buckets', {'set': {'in': duelSets},
+                       'id': {'prefix': ['PVPDR_TEST', 'PVPDR_Duels_Buckets', 'PVPDR_SCH_ComingSoon', 'PVPDR_Empty']}})
+]
+
+
+def compileCondition(field, operator, values):
+    """:return: function(card) true if the condition matches"""
+    if operator == 'in':
+        values = frozenset(values)
+        return lambda card: card.get(field) in values
+    if operator == 'notIn':
+        values = frozenset(values)
+        return lambda card: card.get(field) not in values
+    if operator == 'prefix':
+        values = tuple(values)
+        return lambda card: card.get(field, '').startswith(values)
+    if operator == 'notPrefix':
+        values = tuple(values)
+        return lambda card: not card.get(field, '').startswith(values)
+    if operator == 'contains':
+        return lambda card: any(value in card.get(field, '') for value in values)
+    if operator == 'empty':
+        return lambda card: not card.get(field)
+    raise ValueError('compileCondition() unknown operator ' + operator)
+
+
+def compileRule(rule):
+    """:return: function(card) true if all conditions of the rule match"""
+    conditions = [compileCondition(field, operator, values)
+            for field, condition in rule.items()
+            for operator, values in condition.items()]
+    return lambda card: all(condition(card) for condition in conditions)
+
+
+cardFilters = [(name, compileRule(rule)) for name, rule in cardFilterRules]
+
+
+def knownSet(card):
+    return card.get('set') in jsonToCCSet
+
+
+def cardText(card, data):
+    text = card.get('text')
+    # jade golem and galakrond cards have two texts
+    if card['name'].startswith("Galakrond, the ") and card.get('collectionText'):
+        return fixText(text + "Invoke twice to upgrade." + card.get('collectionText'))
+    return fixText(card.get('collectionText', text))
+
+
+def cardRarity(card, data):
+    rarity = card.get('rarity', 'Token')
+    return 'Basic' if rarity == 'FREE' else camelCase(rarity)
+
+
+def cardClass(card, data):
+    if 'multiClassGroup' in card and 'classes' in card and card['multiClassGroup'] in multiClassGroups:
+        multiClass = multiClassGroups[card['multiClassGroup']]
+        classes = ''.join(c[:1] for c in card['classes'])
+        return '{} ({})'.format(multiClass, classes)
+    if 'classes' in card:
+        return '+'.join(cc.classes.get(camelCase(c), camelCase(c)) for c in card['classes'])
+
+    clazz = camelCase(card.get('cardClass', 'Neutral'))
+    return cc.classes.get(clazz, clazz)
+
+
+def cardSubType(card, data):
+    subtype = camelCase(card.get('race'))
+    mechanics = card.get('mechanics', [])
+    if not subtype and ('QUEST' in mechanics or 'SIDEQUEST' in mechanics):
+        subtype = 'Quest'
+    if not subtype:
+        subtype = camelCase(card.get('spellSchool'))
+    return subtypeFix.get(subtype, subtype)
+
+
+def cardCost(card, data):
+    cost = card.get('cost')
+    if cost is None and card.get('collectible'):
+        log.debug("cardCost() collectible without cost: %s", card)
+        cost = 0
+    if card['set'] == 'BATTLEGROUNDS':
+        cost = card.get('techLevel')
+    if data['desc'] and data['desc'].startswith('Passive') and cost == 0:
+        cost = None
+    return cost
+
+
+# card data fields in order, transform(card, data) gets the hearthstonejson card
+# and the fields before, all transforms share the signature even if unused
+cardFields = [
+    ('id', lambda card, data: card['id']),
+    ('name', lambda card, data: card['name']),
+    ('rarity', cardRarity),
+    ('class', cardClass),
+    ('set', lambda card, data: cc.sets[jsonToCCSet[card['set']]]['name']),
+    ('type', lambda card, data: camelCase(card['type'])),
+    ('subType', cardSubType),
+    ('desc', cardText),
+    ('cost', cardCost),
+    ('atk', lambda card, data: card.get('attack')),
+    ('hp', lambda card, data: card.get('armor', card.get('health', card.get('durability')))),
+    ('collectible', lambda card, data: card.get('collectible', False))
+]
+
+
+def applyCardRules(cards, timings=None):
+    """filter and transform a list of hearthstonejson cards of known sets,
+    rule by rule over all cards
+
+    :param timings: dict filled with seconds per rule
+    :return: list of (hearthstonejson card, card data)
+    """
+    for name, drop in cardFilters:
+        start = time.perf_counter()
+        cards = [card for card in cards if not drop(card)]
+        if timings is not None:
+            timings['filter ' + name] = time.perf_counter() - start
+
+    result = [(card, {}) for card in cards]
+    for field, transform in cardFields:
+        start = time.perf_counter()
+        for card, data in result:
+            data[field] = transform(card, data)
+        if timings is not None:
+            timings['field ' + field] = time.perf_counter() - start
+
+    return result
 
 
 def loadJsonCards():
     log.debug("loadJsonCards() loading latest card texts from hearthstonejson.com")
     # https://github.com/HearthSim/hearthstonejson
-    cardtextjson = getCardJson()
+    # unknown sets are dropped while parsing
+    cardtextjson = list(getCardJson(knownSet))
 
     cards = {}
     tokens = {}
     duels = {}
     vanilla = {}
 
-    for card in cardtextjson:
-        if card.get('set') not in jsonToCCSet:
-            # uncollectible cards and unknown set
-            continue
-        if card.get('set') in ['HERO_SKINS']:
-            # not a real card set
-            continue
-        if card.get('type') not in ['MINION', 'SPELL', 'WEAPON', 'HERO', 'HERO_POWER', 'LOCATION']:
-            # buffs are irrelevant for us
-            continue
-        if  card.get('set') in ['BASIC', 'CORE', 'VANILLA'] + duelSets and card.get('type') in ['HERO', 'HERO_POWER']:
-            # skip default and duels heroes
-            continue
-        if card.get('set') in duelSets and not card['id'].startswith('PVPDR'):
-            # skip tavern brawl cards not used in duels
-            continue
-        if 'DFX' in card['id']:
-            # skip dummy fx
-            continue
-        if card.get('set') == 'BATTLEGROUNDS' and not card.get('techLevel'):
-            # skip upgraded battleground cards
-            continue
-
-        duels_blacklist = ['PVPDR_TEST', 'PVPDR_Duels_Buckets', 'PVPDR_SCH_ComingSoon', 'PVPDR_Empty']
-        blacklistedId = next((word for word in duels_blacklist if card['id'].startswith(word)), False)
-        if card.get('set') in duelSets and blacklistedId:
-            # skip duels buckets
-            continue
-
-        text = card.get('text')
-        # jade golem and galakrond cards have two texts
-        if card['name'].startswith("Galakrond, the ") and card.get('collectionText'):
-            text = fixText(text + "Invoke twice to upgrade." + card.get('collectionText'))
-        else:
-            text = fixText(card.get('collectionText', text))
-
-        rarity = card.get('rarity', 'Token')
-        rarity = 'Basic' if rarity == 'FREE' else camelCase(rarity)
-
-        subtype = camelCase(card.get('race'))
-        mechanics = card.get('mechanics', [])
-        if not subtype and ('QUEST' in mechanics or 'SIDEQUEST' in mechanics):
-            subtype = 'Quest'
-        if not subtype:
-            subtype = camelCase(card.get('spellSchool'))
-
-        clazz = camelCase(card.get('cardClass', 'Neutral'))
-        clazz = cc.classes.get(clazz, clazz)
-
-        if 'multiClassGroup' in card and 'classes' in card and card['multiClassGroup'] in multiClassGroups:
-            multiClass = multiClassGroups[card['multiClassGroup']]
-            classes = ''.join(c[:1] for c in card['classes'])
-            clazz = '{} ({})'.format(multiClass, classes)
-        elif 'classes' in card:
-            clazz = '+'.join(cc.classes.get(camelCase(c), camelCase(c)) for c in card['classes'])
-
-        cardSet = card.get('set')
-        if not cardSet:
-            log.debug("loadJsonCards() collectible without set. HOF? %s", card)
-            cardSet = 'HOF'
-
-        cost = card.get('cost')
-        if cost is None and card.get('collectible'):
-            log.debug("loadJsonCards() collectible without cost: %s", card)
-            cost = 0
-        if cardSet == 'BATTLEGROUNDS':
-            cost = card.get('techLevel')
-        if text and text.startswith('Passive') and cost == 0:
-            cost = None
-
-        if 'name' not in card:
-            print(card)
-
-        cardData = {
-            'id': card['id'],
-            'name': card['name'],
-            'rarity': rarity,
-            'class': clazz,
-            'set': cc.sets[jsonToCCSet[cardSet]]['name'],
-            'type': camelCase(card['type']),
-            'subType': subtypeFix.get(subtype, subtype),
-            'cost': cost,
-            'desc': text,
-            'atk': card.get('attack'),
-            'hp': card.get('armor', card.get('health', card.get('durability'))),
-            'collectible': card.get('collectible', False)
-        }
-
+    for card, cardData in applyCardRules(cardtextjson):
+        cardSet = card['set']
         if cardSet in duelSets:
             duels[card['id']] = cardData
         elif card.get('collectible'):
             if cardSet in vanillaSets:
                 vanilla[card['id']] = cardData
             else:
-                # if card['id'] not in cards:
                 cards[card['id']] = cardData
         else:
             if cardSet not in vanillaSets:
@@ -357,7 +609,8 @@ def saveCardsAsJson(filename, cards):
 
 
 # default loop all ['02','06','08', ...]
-def loadSets(allcards={}, sets=setids.keys()):
+# finished cards are added to the optional journal
+def loadSets(allcards={}, sets=setids.keys(), journal=None):
     log.debug("loadSets() %s cards %s sets", len(allcards), len(sets))
     # grp by set
     setcarddata = {}
@@ -383,118 +636,177 @@ def loadSets(allcards={}, sets=setids.keys()):
             if name not in resultCards or getsetid(card["set"]) > getsetid(resultCards[name]["set"]):
                 resultCards[name] = card
 
-    def doSet(setid):
-        with requests.Session() as session:
-            setname = cc.sets[setid]['name']
-            filename = "data/{} {}.json".format(setid, setname)
+    work = {}
+    for setid in sets:
+        setname = cc.sets[setid]['name']
+        filename = "data/{} {}.json".format(setid, setname)
 
-            if os.path.isfile(filename):
-                log.debug("loadSets() using found '%s' file instead of internet", filename)
-                with open(filename, 'r', encoding='utf8') as f:
-                    update(json.load(f))
+        if os.path.isfile(filename):
+            log.debug("loadSets() using found '%s' file instead of internet", filename)
+            with open(filename, 'r', encoding='utf8') as f:
+                update(json.load(f))
+        else:
+            log.debug("loadSets() getting set from internet %s", setname)
+            work[setid] = setcarddata.get(setname, [])
+
+    # cards of all sets share the workers
+    items = [(setid, card) for setid, cards in work.items() for card in cards]
+    with PoliteSession() as session:
+        results = runAll([lambda setid=setid, card=card:
+                scrapeCard(card, setid, session, journal) for setid, card in items])
+
+    error = None
+    for setid in work:
+        setname = cc.sets[setid]['name']
+        currentSet = {}
+        complete = True
+
+        for (cardSet, card), (result, e) in zip(items, results):
+            if cardSet != setid:
+                continue
+            if e:
+                complete = False
+                error = error or e
+            elif not result:
+                continue
+            elif card['name'] in currentSet:
+                log.debug("loadSets() found '%s' again", card['name'])
             else:
-                log.debug("loadSets() getting set from internet %s", setname)
-                currentSet = {}
-
-                for card in setcarddata.get(setname, []):
-                    name = 'Travelling Healer' if card['name'] == 'Traveling Healer' else card['name']
-                    try:
-                        hpid, image = getHearthpwnIdAndUrl(name,
-                                                            setname,
-                                                            card['type'],
-                                                            cc.sets[setid].get('duels'),
-                                                            session)
-
-                        card['cdn'] = image
-                        card['hpwn'] = hpid
-                    except Exception as e:
-                        try:
-                            urlName = getHTDId(name)
-                            url = 'https://www.hearthstonetopdecks.com/cards/{}/'.format(urlName)
-                            _, cardHTD = parseHTD(url, session)
-                            card['cdn'] = cardHTD['cdn']
-                            card['hpwn'] = 12288
-                        except Exception as e2:
-                            log.exception("doSet() card %s also not at htd %s", card, e)
-                            if card['collectible']:
-                                raise e2
-                            log.exception("doSet() skipping card for error %s", e)
-                            continue
-
-                    card['head'] = getHTDId(name)
-                    if card['name'] in currentSet:
-                        log.debug("loadSets() found '%s' again", card['name'])
-                    else:
-                        currentSet[card['name']] = card
-                    print('.', end='')
+                currentSet[card['name']] = card
 
-                saveCardsAsJson(filename, currentSet)
-                resultCards.update(currentSet)
-                update(currentSet)
+        if complete:
+            saveCardsAsJson("data/{} {}.json".format(setid, setname), currentSet)
+            resultCards.update(currentSet)
+            update(currentSet)
 
-    with Pool(4) as p:
-        p.map(doSet, sets)
+    if error:
+        raise error
 
     return resultCards
 
 
-def loadTokens(tokens = {}, wantedTokens = {}):
-    resultCards = {}
-    with requests.Session() as session:
-        for name, ids in wantedTokens.items():
-            card = None
-
-            if 'id' in ids:
-                card = tokens[ids['id']]
-                if name != card['name']:
-                    log.warning('loadTokens() names do not match: %s - %s', name, tokens[ids['id']]['name'])
-
-            if 'id' not in ids:
-                for token in tokens.values():
-                    if name == token['name']:
-                        if card:
-                            log.warning('loadTokens() found token again: %s', name)
-                        card = token
-
-            if not card:
-                log.error('loadTokens() could not find: %s', name)
-                print('token not found:', name)
-                exit()
-
-            if 'hpwn' in ids:
-                r = session.get('https://www.hearthpwn.com/cards/{}'.format(ids['hpwn']))
-                r.raise_for_status()
-                image = fromstring(r.text).xpath('//img[@class="hscard-static"]')[0].get('src')
-                if not image:
-                    image = 'https://media-hearth.cursecdn.com/avatars/148/738/687.png'
-
-                card['cdn'] = image.replace('http://', 'https://')
-                card['hpwn'] = ids['hpwn']
-                card['head'] = getHTDId(card['name'])
-
-                # since jade golem: overwrite scraped stats with prepared ones
-                card['atk'] = ids.get('atk', card['atk'])
-                card['cost'] = ids.get('cost', card['cost'])
-                card['hp'] = ids.get('hp', card['hp'])
-            else:
-                urlName = getHTDId(card['name'])
+def scrapeCard(card, setid, session, journal=None):
+    """add hearthpwn id, image and htd id to card
+
+    :return: card or None if it is skipped
+    """
+    setname = cc.sets[setid]['name']
+    name = 'Travelling Healer' if card['name'] == 'Traveling Healer' else card['name']
+    key = 'card/{}/{}'.format(setid, card['id'])
+    found = journal.get(key) if journal else None
+
+    if found is None:
+        try:
+            hpid, image = getHearthpwnIdAndUrl(name,
+                                                setname,
+                                                card['type'],
+                                                cc.sets[setid].get('duels'),
+                                                session)
+            found = {'cdn': image, 'hpwn': hpid}
+        except Exception as e:
+            try:
+                urlName = getHTDId(name)
                 url = 'https://www.hearthstonetopdecks.com/cards/{}/'.format(urlName)
                 _, cardHTD = parseHTD(url, session)
-                if not cardHTD.get("desc") and card.get('desc'):
-                    cardHTD["desc"] = card.get('desc')
-                cardHTD["id"] = card["id"]
-                card = cardHTD
-                if card["set"] == 'Arena Exclusives':
-                    card["set"] = 'Taverns of Time'
+                found = {'cdn': cardHTD['cdn'], 'hpwn': 12288}
+            except Exception as e2:
+                log.exception("scrapeCard() card %s also not at htd %s", card, e)
+                if card['collectible']:
+                    raise e2
+                log.exception("scrapeCard() skipping card for error %s", e)
+                found = {'skip': True}
+
+        if journal:
+            journal.put(key, found)
+
+    if found.get('skip'):
+        return None
+
+    card['cdn'] = found['cdn']
+    card['hpwn'] = found['hpwn']
+    card['head'] = getHTDId(name)
+    print('.', end='')
+    return card
+
+
+def loadTokens(tokens = {}, wantedTokens = {}, journal=None):
+    found = []
+    for name, ids in wantedTokens.items():
+        card = None
+
+        if 'id' in ids:
+            card = tokens[ids['id']]
+            if name != card['name']:
+                log.warning('loadTokens() names do not match: %s - %s', name, tokens[ids['id']]['name'])
+
+        if 'id' not in ids:
+            for token in tokens.values():
+                if name == token['name']:
+                    if card:
+                        log.warning('loadTokens() found token again: %s', name)
+                    card = token
+
+        if not card:
+            log.error('loadTokens() could not find: %s', name)
+            print('token not found:', name)
+            exit()
+
+        found.append((name, ids, card))
+
+    with PoliteSession() as session:
+        results = runAll([lambda name=name, ids=ids, card=card:
+                scrapeToken(name, ids, card, session, journal) for name, ids, card in found])
 
-            resultCards[card['name']] = card
-            print('.', end='')
+    resultCards = {}
+    for card, error in results:
+        if error:
+            raise error
+        resultCards[card['name']] = card
 
     print('loaded tokens:', len(resultCards))
     return resultCards
 
 
-def loadAndSaveTokens(allTokens, *, force=False):
+def scrapeToken(name, ids, card, session, journal=None):
+    """image and ids of a token from hearthpwn or the whole card from htd"""
+    key = 'token/' + name
+    done = journal.get(key) if journal else None
+    if done is not None:
+        return done
+
+    if 'hpwn' in ids:
+        r = session.get('https://www.hearthpwn.com/cards/{}'.format(ids['hpwn']))
+        r.raise_for_status()
+        image = fromstring(r.text).xpath('//img[@class="hscard-static"]')[0].get('src')
+        if not image:
+            image = 'https://media-hearth.cursecdn.com/avatars/148/738/687.png'
+
+        card['cdn'] = image.replace('http://', 'https://')
+        card['hpwn'] = ids['hpwn']
+        card['head'] = getHTDId(card['name'])
+
+        # since jade golem: overwrite scraped stats with prepared ones
+        card['atk'] = ids.get('atk', card['atk'])
+        card['cost'] = ids.get('cost', card['cost'])
+        card['hp'] = ids.get('hp', card['hp'])
+    else:
+        urlName = getHTDId(card['name'])
+        url = 'https://www.hearthstonetopdecks.com/cards/{}/'.format(urlName)
+        _, cardHTD = parseHTD(url, session)
+        if not cardHTD.get("desc") and card.get('desc'):
+            cardHTD["desc"] = card.get('desc')
+        cardHTD["id"] = card["id"]
+        card = cardHTD
+        if card["set"] == 'Arena Exclusives':
+            card["set"] = 'Taverns of Time'
+
+    if journal:
+        journal.put(key, card)
+    print('.', end='')
+    return card
+
+
+def loadAndSaveTokens(allTokens, *, force=False, journal=None):
     # a lot of token names are not unique
     # a static, handmade list of ids is more reliable
     if os.path.isfile('data/tokenlist.json'):
@@ -510,45 +822,54 @@ def loadAndSaveTokens(allTokens, *, force=False):
                 if card.get('set') == "Taverns of Time" and card.get('name') not in tokenlist:
                     tokenlist[card.get('name')] = {}
 
-            saveCardsAsJson("data/tokens.json", loadTokens(allTokens, tokenlist))
+            saveCardsAsJson("data/tokens.json", loadTokens(allTokens, tokenlist, journal))
 
 
 def main(setId=None):
+    journal = None
     try:
-        log.debug("main() full scrape will take 5+ minutes")
+        log.debug("main() full scrape will take some minutes")
         cards, tokens, duels, vanilla = loadJsonCards()
+        # an interrupted scrape continues where it stopped
+        journal = Journal()
 
         if setId:
             if setId == 'tokens':
-                loadAndSaveTokens(tokens, force=True)
-                return
-            if setId not in setids:
+                loadAndSaveTokens(tokens, force=True, journal=journal)
+            elif setId not in setids:
                 print('unkown setId:', setId, 'known sets:', setids)
-                return
-            loadSets(allcards=cards, sets=[setId])
+            else:
+                loadSets(allcards=cards, sets=[setId], journal=journal)
+            # keep the checkpoint of an interrupted full scrape
+            journal.close()
             return
 
         cardSetIds = setids.keys() - duelSetIds - set(vanillaSetIds)
-        saveCardsAsJson("data/cards.json", loadSets(allcards=cards, sets=cardSetIds))
-        saveCardsAsJson("data/duels.json", loadSets(allcards=duels, sets=duelSetIds))
+        saveCardsAsJson("data/cards.json", loadSets(allcards=cards, sets=cardSetIds, journal=journal))
+        saveCardsAsJson("data/duels.json", loadSets(allcards=duels, sets=duelSetIds, journal=journal))
         if not os.path.isfile('data/vanilla.json'):
-            saveCardsAsJson("data/vanilla.json", loadSets(allcards=vanilla, sets=vanillaSetIds))
+            saveCardsAsJson("data/vanilla.json", loadSets(allcards=vanilla, sets=vanillaSetIds, journal=journal))
 
-        loadAndSaveTokens(tokens)
+        loadAndSaveTokens(tokens, journal=journal)
+        journal.close(finished=True)
+        # precompile for fast bot startup
+        CardDB(constants=cc).saveSnapshot('data/cards.snapshot')
         print("success")
     except Exception as e:
         log.exception("main() error %s", e)
         print("error", e)
+        if journal:
+            journal.close()
 
 
-def parseSingle(hpid):
+def parseSingle(hpid, requests=requests):
     try:
-        return parseSingleThrowing(hpid)
+        return parseSingleThrowing(hpid, requests)
     except Exception as e:
         log.exception("parseSingle() card %s error %s", hpid, e)
         return "", {}
 
-def parseSingleThrowing(hpid):
+def parseSingleThrowing(hpid, requests=requests):
     def getFirst(list):
         try:
             return list[0]
@@ -647,7 +968,8 @@ def expandIds(ids):
 
 
 def parseMultiple(ids):
-    return "".join(formatSingle(*parseSingle(id)) for id in expandIds(ids))
+    with PoliteSession() as session:
+        return "".join(formatSingle(*parseSingle(id, session)) for id in expandIds(ids))
 
 
 def parseHTD(url, requests=requests):
@@ -729,11 +1051,15 @@ if __name__ == "__main__":
             level=log.DEBUG)
 
     log.debug("scrape started with parameters: %s", sys.argv)
+    if '--offline' in sys.argv:
+        # replay from the http cache only
+        sys.argv.remove('--offline')
+        httpCache.offline = True
     if len(sys.argv) > 1:
         result = ""
         if 'hearthstonetopdecks' in sys.argv[1]:
             log.debug("loading single htd url: %s", sys.argv)
-            with requests.Session() as session:
+            with PoliteSession() as session:
                 for url in sys.argv[1:]:
                     if 'cards' in url:
                         urls = [url]
@@ -742,7 +1068,7 @@ if __name__ == "__main__":
                     result += "".join(formatSingle(*parseHTD(url, session)) for url in urls)
         elif 'htd' in sys.argv[1]:
             log.debug("loading htd pages: %s", sys.argv)
-            with requests.Session() as session:
+            with PoliteSession() as session:
                 urls = []
                 for u in list(parseHTDPageNumber(page, session) for page in expandIds(sys.argv[2:])):
                     urls += u
@@ -0,0 +1,64 @@
+
+import contextlib
+import logging as log
+import sqlite3
+import threading
+
+
+class Storage():
+    """One sqlite connection shared by the stores of the bot, other db
+    files are attached. All files use a write ahead log and synchronous
+    NORMAL. Writes of a round share one transaction, the owner ends it
+    with commit(). Thread-safe with lock.
+
+    In WAL mode the commit is atomic per file only, not across attached
+    files. After a crash one file may have the round and another not.
+    """
+
+    def __init__(self, dbName='praww.db', attach=None, cachedStatements=256):
+        """
+        :param dbName: main db file
+        :param attach: dict of schema name to db file
+        :param cachedStatements: number of prepared statements kept
+        """
+        # transactions are started and ended by hand
+        self.conn = sqlite3.connect(dbName, check_same_thread=False,
+                isolation_level=None, cached_statements=cachedStatements)
+        self.lock = threading.RLock()
+
+        attach = attach or {}
+        for schema, fileName in attach.items():
+            self.conn.execute('ATTACH DATABASE ? AS {}'.format(schema), (fileName, ))
+
+        for schema in ['main'] + list(attach):
+            self.conn.execute('PRAGMA {}.journal_mode=WAL'.format(schema))
+            # a crash may lose the last transaction, never corrupts
+            self.conn.execute('PRAGMA {}.synchronous=NORMAL'.format(schema))
+
+    def __str__(self):
+        return repr(self.conn)
+
+    @contextlib.contextmanager
+    def write(self):
+        """lock and join the transaction of the round"""
+        with self.lock:
+            if not self.conn.in_transaction:
+                self.conn.execute('BEGIN')
+            yield self.conn
+
+    def commit(self):
+        """end the transaction of the round, one disk sync"""
+        with self.lock:
+            if self.conn.in_transaction:
+                self.conn.execute('COMMIT')
+
+    def rollback(self):
+        with self.lock:
+            if self.conn.in_transaction:
+                log.warning('rollback() dropping writes of the round')
+                self.conn.execute('ROLLBACK')
+
+    def close(self):
+        with self.lock:
+            self.commit()
+            self.conn.close()
@@ -1,18 +1,26 @@
 #!/usr/bin/env python3
 
+import io
+import itertools
 import json
 import logging
 import os
 import os.path
+import re
+import shutil
 import sys
+import threading
 import time
 import unittest
 from unittest.mock import MagicMock
 from unittest.mock import call
+from unittest.mock import patch
 import uuid
 
 import praw
 from praw.config import Config
+from praw.models import Comment
+from praw.models import Message
 import prawcore
 import requests
 
@@ -26,9 +34,20 @@ import formatter
 from cardDB import CardDB
 from constants import Constants
 from helper import HSHelper
+from helper import LRUCache
 from helper import SpellChecker
+from metrics import Metrics
+from retention import Retention
+from storage import Storage
+from praww import RateLimited
 from praww import RedditBot
+from praww import _BloomFilter
+from praww import _LimitedRequestor
+from praww import _Outbox
+from praww import _RateLimiter
 from praww import _SeenDB
+from praww import _TokenBucket
+from praww import _rateLimitSeconds
 
 
 # start with 'test.py online' to start slow tests requiring internet and working credentials
@@ -76,6 +95,189 @@ class TestScrape(unittest.TestCase):
         self.assertEqual(scrape.camelCase(""), None)
         self.assertEqual(scrape.camelCase(None), None)
 
+    def test_Journal(self):
+        fileName = 'test_scrape.journal'
+        journal = scrape.Journal(fileName)
+        journal.put('card/01/1', {'name': 'Quick Shot'})
+        journal.put('card/01/2', {'skip': True})
+        journal.close()
+        # interrupted while writing
+        with open(fileName, 'a') as f:
+            f.write('{"key": "card/01/3", "val')
+
+        journal = scrape.Journal(fileName)
+        self.assertEqual(journal.get('card/01/1'), {'name': 'Quick Shot'})
+        self.assertEqual(journal.get('card/01/2'), {'skip': True})
+        self.assertIsNone(journal.get('card/01/3'))
+
+        # interrupted again, results of both runs are kept
+        journal.put('card/01/3', {'name': 'Upgrade!'})
+        journal.close()
+        with open(fileName, 'a') as f:
+            f.write('{"key": "card/01/4", "val')
+
+        journal = scrape.Journal(fileName)
+        self.assertEqual(journal.get('card/01/1'), {'name': 'Quick Shot'})
+        self.assertEqual(journal.get('card/01/3'), {'name': 'Upgrade!'})
+        self.assertIsNone(journal.get('card/01/4'))
+        journal.put('card/01/4', {'skip': True})
+        journal.close()
+
+        journal = scrape.Journal(fileName)
+        self.assertEqual(journal.get('card/01/4'), {'skip': True})
+        journal.close(finished=True)
+        self.assertFalse(os.path.isfile(fileName))
+
+    def test_JournalPartialScrape(self):
+        fileName = 'test_scrape.journal'
+        journal = scrape.Journal(fileName)
+        journal.put('card/01/1', {'name': 'Quick Shot'})
+        journal.close()
+
+        # a single set run keeps the checkpoint of a full scrape
+        Journal = scrape.Journal
+        with patch('scrape.loadJsonCards', return_value=({}, {}, {}, {})), \
+                patch('scrape.Journal', lambda: Journal(fileName)):
+            scrape.main('unknownSet')
+
+        journal = scrape.Journal(fileName)
+        self.assertEqual(journal.get('card/01/1'), {'name': 'Quick Shot'})
+        journal.close(finished=True)
+
+    def test_HTTPCache(self):
+        directory = 'test-http-cache'
+        calls = []
+
+        def fetch(url, params=None, headers=None):
+            calls.append(headers)
+            r = requests.Response()
+            r.url = url
+            r.encoding = 'utf8'
+            if headers.get('If-None-Match') == '"v1"':
+                r.status_code = 304
+                r._content = b''
+            else:
+                r.status_code = 200
+                r._content = b'<html>card</html>'
+                r.headers['ETag'] = '"v1"'
+            return r
+
+        try:
+            cache = scrape.HTTPCache(directory, ttl=60, listingTtl=60)
+            self.assertEqual(cache.get('https://a/cards', fetch, {'id': 1}).text, '<html>card</html>')
+            # fresh, no request
+            self.assertEqual(cache.get('https://a/cards', fetch, {'id': 1}).text, '<html>card</html>')
+            self.assertEqual(calls, [{}])
+
+            # stale, revalidated
+            cache.listingTtl = -1
+            self.assertEqual(cache.get('https://a/cards', fetch, {'id': 1}).text, '<html>card</html>')
+            self.assertEqual(calls[1], {'If-None-Match': '"v1"'})
+
+            offline = scrape.HTTPCache(directory, offline=True)
+            self.assertEqual(offline.get('https://a/cards', fetch, {'id': 1}).text, '<html>card</html>')
+            with self.assertRaises(requests.ConnectionError):
+                offline.get('https://a/cards', fetch, {'id': 2})
+            self.assertEqual(len(calls), 2)
+
+            # only card detail pages are kept long
+            self.assertEqual(cache.ttlFor('https://www.hearthpwn.com/cards/14459'), 60)
+            self.assertEqual(cache.ttlFor(
+                    'https://www.hearthstonetopdecks.com/cards/quick-shot/'), 60)
+            self.assertEqual(cache.ttlFor('https://www.hearthpwn.com/cards',
+                    {'filter-name': 'Quick Shot'}), -1)
+            self.assertEqual(cache.ttlFor(scrape.setUrlTempl.format('', 1, 4, 2)), -1)
+            self.assertEqual(cache.ttlFor(
+                    'https://www.hearthstonetopdecks.com/page/2/'), -1)
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    def test_iterJsonArray(self):
+        cards = [{'id': 'A_{}'.format(i), 'text': 'Deal [x]{} damage, "quoted" ]'.format(i),
+                'mechanics': ['TAUNT'], 'cost': i} for i in range(50)]
+        text = json.dumps(cards, indent=2)
+        # chunks smaller than one card
+        self.assertEqual(list(scrape.iterJsonArray(io.StringIO(text), 7)), cards)
+        self.assertEqual(list(scrape.iterJsonArray(io.StringIO(' [ ] '))), [])
+
+        with self.assertRaises(ValueError):
+            list(scrape.iterJsonArray(io.StringIO(text[:-20]), 7))
+
+    def test_CardRules(self):
+        drop = scrape.compileRule({'set': {'in': ['TB']}, 'id': {'notPrefix': ['PVPDR']}})
+        self.assertTrue(drop({'set': 'TB', 'id': 'TB_01'}))
+        self.assertFalse(drop({'set': 'TB', 'id': 'PVPDR_01'}))
+        self.assertFalse(drop({'set': 'CORE', 'id': 'TB_01'}))
+        with self.assertRaises(ValueError):
+            scrape.compileRule({'id': {'like': ['TB']}})
+
+        cards = [
+            {'id': 'CORE_01', 'name': 'Quest', 'set': 'CORE', 'type': 'SPELL', 'cost': 1,
+                'text': '<b>Quest:</b> Play\n$2 cards.', 'mechanics': ['QUEST'],
+                'cardClass': 'DEMONHUNTER', 'rarity': 'FREE', 'collectible': True},
+            {'id': 'CORE_02', 'name': 'Buff', 'set': 'CORE', 'type': 'ENCHANTMENT'},
+            {'id': 'CORE_DFX_03', 'name': 'Fx', 'set': 'CORE', 'type': 'SPELL'}
+        ]
+        self.assertFalse(scrape.knownSet({'id': 'X_04', 'set': 'XYZ'}))
+        timings = {}
+        result = scrape.applyCardRules(cards, timings)
+
+        self.assertEqual([data for _, data in result], [{
+            'id': 'CORE_01', 'name': 'Quest', 'rarity': 'Basic', 'class': 'DH',
+            'set': 'Core Set 2021', 'type': 'Spell', 'subType': 'Quest', 'desc': 'Quest: Play 2 cards.',
+            'cost': 1, 'atk': None, 'hp': None, 'collectible': True
+        }])
+        self.assertIn('filter dummy fx', timings)
+        self.assertIn('field desc', timings)
+
+    def referenceFixText(text):
+        """fixText before the fast paths"""
+        if text:
+            text = re.sub(r"</?\w+>", '', text)
+            text = text.replace('\n', ' ').replace('\u2019', "'").replace('$', '') \
+                    .replace('[x]', '').replace('\u00A0', ' ').replace('#', '')
+            text = re.sub(r"[ ]{2,}", ' ', text)
+            text = text.strip()
+        return text
+
+    def test_fixText(self):
+        texts = [None, '', 'Draw a card.', '[x]<b>Battlecry:</b> Deal $3 damage.\nGain #4\u00A0Armor.',
+                '[$x]a', '[<b>x]a', '<$b>', '[#x]', 'a < b > c', ' \u2019 \n  x\t']
+
+        for text in texts:
+            self.assertEqual(scrape.fixText(text), TestScrape.referenceFixText(text), repr(text))
+
+    def test_fixTextRawCards(self):
+        if not os.path.isfile('raw-cards.json'):
+            self.skipTest('raw-cards.json missing, run scrape.py once')
+
+        with open('raw-cards.json', encoding='utf8') as f:
+            for card in scrape.iterJsonArray(f):
+                for field in ('name', 'text', 'collectionText'):
+                    text = card.get(field)
+                    self.assertEqual(scrape.fixText(text),
+                            TestScrape.referenceFixText(text), repr(text))
+
+    def test_CardJsonOffline(self):
+        with patch('scrape.httpCache.offline', True), \
+                patch('scrape.requests.get') as get:
+            if os.path.isfile('raw-cards.json'):
+                # an old copy is used as is
+                list(scrape.getCardJson(lambda card: False))
+            else:
+                with self.assertRaises(requests.ConnectionError):
+                    list(scrape.getCardJson())
+        get.assert_not_called()
+
+    def test_runAll(self):
+        def fail():
+            raise ValueError('failed')
+
+        results = scrape.runAll([lambda: 1, fail, lambda: 3], workers=2)
+        self.assertEqual([r for r, _ in results], [1, None, 3])
+        self.assertIsNone(results[0][1])
+        self.assertIsInstance(results[1][1], ValueError)
+
     # @unittest.skipIf(SKIP_INTERNET_TESTS, "requires internet (and is slow)")
     def test_hearthhead(self):
         with requests.Session() as s:
@@ -284,6 +486,90 @@ class TestCommentDB(unittest.TestCase):
 
     testDBName = "test.db"
 
+    def test_ExistsMany(self):
+        with TempFile('db') as dbfile:
+            db = commentDB.DB(dbfile)
+            self.assertFalse(db.exists("abc", ["a card"]))
+
+            result = db.existsMany([
+                ("abc", ["a card"]),
+                ("abc", ["a card", "b card"]),
+                ("123", ["a card"]),
+                # same round, inserted by the request before
+                ("abc", ["b card"]),
+                ("123", ["a card"])
+            ])
+            self.assertEqual(result, [True, False, False, True, True])
+            self.assertTrue(db.exists("abc", ["a card", "b card"]))
+            self.assertEqual(db.existsMany([]), [])
+            db.close()
+
+    def test_CardCounts(self):
+        with TempFile('db') as dbfile:
+            db = commentDB.DB(dbfile)
+            db.exists("abc", ["a card", "b card"])
+            db.exists("123", ["a card"])
+            self.assertEqual(db.cardCounts(), {"a card": 2, "b card": 1})
+            db.close()
+
+    def test_SharedStorage(self):
+        with TempFile('db') as mainFile, TempFile('db') as answeredFile:
+            storage = Storage(mainFile, attach={'answered': answeredFile})
+            db = commentDB.DB(storage=storage, schema='answered')
+            seenDB = _SeenDB(storage=storage)
+
+            class Thing():
+                fullname = "t1_thingid"
+
+            # one transaction for both files
+            db.exists("abc", ["a card"])
+            seenDB.isSeen(Thing())
+            seenDB.flush()
+
+            other = commentDB.DB(answeredFile)
+            self.assertEqual(other.cardCounts(), {}, 'not committed')
+            storage.commit()
+            self.assertEqual(other.cardCounts(), {"a card": 1})
+            other.close()
+
+            for schema in ('main', 'answered'):
+                mode = storage.conn.execute('PRAGMA {}.journal_mode'.format(schema))
+                self.assertEqual(mode.fetchone()[0], 'wal')
+
+            seenDB.close()
+            db.close()
+            storage.close()
+            seenDB = _SeenDB(mainFile)
+            self.assertTrue(seenDB.isSeen(Thing()))
+            seenDB.close()
+
+    def test_Retention(self):
+        with TempFile('db') as dbfile:
+            db = commentDB.DB(dbfile)
+            self.assertEqual(db.conn.execute('PRAGMA auto_vacuum').fetchone()[0], 2)
+
+            old = int(time.time()) - 100
+            with db.conn:
+                db.conn.executemany("INSERT INTO topcomment (submission_id, card, created)"
+                        " VALUES (?, ?, ?)", [(str(i), 'card', old) for i in range(5)])
+            db.exists("new", ["card"])
+
+            retention = Retention(batchSize=2, vacuumInterval=0)
+            retention.add(db, 50)
+            count = lambda: db.conn.execute('SELECT COUNT(1) FROM topcomment').fetchone()[0]
+
+            # one small batch per round until done
+            retention.run()
+            self.assertEqual(count(), 4)
+            retention.run()
+            self.assertEqual(count(), 2)
+            retention.run()
+            self.assertEqual(count(), 1)
+            retention.run()
+            self.assertEqual(count(), 1, 'not due')
+            self.assertTrue(db.exists("new", ["card"]))
+            db.close()
+
     def test_CreateFindFailParent(self):
         removeFile(self.testDBName)
 
@@ -303,6 +589,36 @@ class TestCommentDB(unittest.TestCase):
         removeFile(self.testDBName)
 
 
+class TestMetrics(unittest.TestCase):
+    """metrics.py"""
+
+    def test_Metrics(self):
+        metrics = Metrics(prefix='test', buckets=(0.1, 1))
+        metrics.count('things')
+        metrics.count('things', 2)
+        metrics.gauge('age', 5)
+        metrics.observe('phase', 0.05)
+        metrics.observe('phase', 0.5)
+        metrics.observe('phase', 2)
+        with metrics.timer('phase'):
+            pass
+
+        self.assertEqual(metrics.counter('things'), 3)
+        self.assertEqual(metrics.histogram('phase')[0], 4)
+
+        with TempFile('prom') as promFile:
+            metrics.dump(promFile)
+            with open(promFile, 'r') as f:
+                lines = f.read().splitlines()
+
+        self.assertIn('test_things_total 3', lines)
+        self.assertIn('test_age 5', lines)
+        self.assertIn('test_phase_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_phase_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('test_phase_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('test_phase_seconds_count 4', lines)
+
+
 class TestPRAWW(unittest.TestCase):
     """praww.py"""
 
@@ -345,6 +661,320 @@ class TestPRAWW(unittest.TestCase):
                 os.rename('_praw.ini', 'praw.ini')
 
 
+    def test_ListingCursor(self):
+        class Thing():
+            def __init__(self, fullname, author='user'):
+                self.fullname = fullname
+                self.author = author
+
+        pages = [[Thing('t1_c'), Thing('t1_b')], [], [], [], [], [Thing('t1_c')]]
+        listing = MagicMock(side_effect=lambda **kwargs: pages.pop(0))
+
+        reddit = MagicMock()
+        reddit.auth.scopes.return_value = ['submit', 'privatemessages',
+                'read', 'identity']
+        reddit.subreddit.return_value.comments = listing
+        # the cursor thing is there, then deleted
+        reddit.info.side_effect = [[Thing('t1_c')], [Thing('t1_c', None)]]
+        listener = MagicMock()
+
+        def postAction():
+            if not pages:
+                removeFile(RedditBot.LOCK_FILE)
+
+        with patch('praww.praw.Reddit', return_value=reddit), \
+                TempFile('db') as seenDB:
+            bot = RedditBot(subreddits=['sub'], sleep=0, dbName=seenDB) \
+                    .withCommentListener(listener)
+            bot.CURSOR_EMPTY_ROUNDS = 2
+            bot.run(postAction)
+
+        self.assertEqual(listing.call_args_list, [
+            # full page without cursor
+            call(limit=25),
+            # only newer things
+            call(limit=25, params={'before': 't1_c'}),
+            call(limit=25, params={'before': 't1_c'}),
+            # the cursor is checked, still there
+            call(limit=25, params={'before': 't1_c'}),
+            call(limit=25, params={'before': 't1_c'}),
+            # deleted, full page
+            call(limit=25)])
+        reddit.info.assert_called_with(fullnames=['t1_c'])
+        self.assertEqual(reddit.info.call_count, 2)
+        self.assertEqual(listener.call_count, 2)
+
+    def test_TokenBucket(self):
+        bucket = _TokenBucket(50, 2)
+        start = time.monotonic()
+        for _ in range(4):
+            bucket.take()
+        # burst of two, then 50 per second
+        self.assertGreater(time.monotonic() - start, 0.035)
+
+        # paused buckets do not wait
+        bucket.pause(0.2)
+        start = time.monotonic()
+        self.assertFalse(bucket.take())
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertGreater(bucket.pausedFor(), 0.1)
+        time.sleep(0.2)
+        self.assertEqual(bucket.pausedFor(), 0)
+        self.assertTrue(bucket.take())
+
+        # waiting for a token stops when cancelled
+        slow = _TokenBucket(0.01, 1)
+        self.assertTrue(slow.take())
+        start = time.monotonic()
+        self.assertFalse(slow.take(cancel=lambda: True))
+        self.assertLess(time.monotonic() - start, 0.1)
+
+    def test_RateLimiterPausedWrites(self):
+        limiter = _RateLimiter(100, 100, 1)
+        limiter.pauseWrites(60)
+        self.assertGreater(limiter.writesPausedFor(), 59)
+        # reads go on
+        limiter.acquire(False)
+        with self.assertRaises(RateLimited) as e:
+            limiter.acquire(True)
+        self.assertGreater(e.exception.seconds, 59)
+
+    def test_LimitedRequestor(self):
+        limiter = MagicMock(spec=_RateLimiter)
+        session = MagicMock()
+        session.request.return_value.headers = {'x-ratelimit-remaining': '10'}
+        requestor = _LimitedRequestor(user_agent='test agent',
+                session=session, limiter=limiter)
+
+        requestor.request('GET', 'https://oauth.reddit.com/comments')
+        limiter.acquire.assert_called_once_with(False)
+        limiter.update.assert_called_once_with({'x-ratelimit-remaining': '10'})
+
+        requestor.request('POST', 'https://oauth.reddit.com/api/comment')
+        limiter.acquire.assert_called_with(True)
+
+        # token requests are not limited
+        limiter.reset_mock()
+        requestor.request('POST', 'https://www.reddit.com/api/v1/access_token')
+        limiter.acquire.assert_not_called()
+
+    def test_RateLimiterHeaders(self):
+        limiter = _RateLimiter(100, 100, 1)
+        limiter.update({'x-ratelimit-remaining': '0', 'x-ratelimit-reset': '1'})
+        # quota used up, reads and writes wait for the reset
+        with self.assertRaises(RateLimited):
+            limiter.acquire(False)
+        self.assertGreater(limiter.writesPausedFor(), 0.9)
+        time.sleep(1)
+        limiter.acquire(False)
+
+        self.assertEqual(_rateLimitSeconds('try again in 9 minutes.', 1), 540)
+        self.assertEqual(_rateLimitSeconds('try again in 5 seconds.', 1), 5)
+        self.assertEqual(_rateLimitSeconds(None, 1), 1)
+
+    def test_Inbox(self):
+        def thing(spec, fullname, subject):
+            item = MagicMock(spec=spec)
+            item.fullname = fullname
+            item.author = 'user'
+            item.subject = subject
+            item.link_id = 't3_a'
+            return item
+
+        pm = thing(Message, 't4_pm', 'hi')
+        mention = thing(Comment, 't1_mention', 'username mention')
+        commentReply = thing(Comment, 't1_reply', 'comment reply')
+        items = [pm, mention, commentReply]
+        pmListener = MagicMock()
+        mentionListener = MagicMock()
+
+        reddit = MagicMock()
+        reddit.auth.scopes.return_value = ['submit', 'privatemessages',
+                'read', 'identity']
+        reddit.inbox.unread.return_value = items
+        # listeners are done before marking read
+        reddit.inbox.mark_read.side_effect = lambda things: \
+                self.assertEqual(mentionListener.call_count, 1)
+
+        with patch('praww.praw.Reddit', return_value=reddit), \
+                TempFile('db') as seenDB:
+            RedditBot(subreddits=['sub'], sleep=0, dbName=seenDB) \
+                    .withPMListener(pmListener) \
+                    .withMentionListener(mentionListener) \
+                    .run(lambda: removeFile(RedditBot.LOCK_FILE))
+
+        reddit.inbox.unread.assert_called_once_with(limit=25)
+        pmListener.assert_called_once_with(reddit, pm)
+        mentionListener.assert_called_once_with(reddit, mention)
+        # all read in one call
+        reddit.inbox.mark_read.assert_called_once_with(items)
+
+    def test_InboxListenerFails(self):
+        if not hasattr(praw.exceptions, 'APIException'):
+            self.skipTest('failed rounds need praw.exceptions.APIException, praw < 8')
+
+        pm = MagicMock(spec=Message)
+        pm.fullname = 't4_pm'
+        pm.author = 'user'
+        other = MagicMock(spec=Message)
+        other.fullname = 't4_other'
+        other.author = 'user'
+        items = [other, pm]
+        calls = []
+
+        def answer(r, thing):
+            calls.append(thing)
+            if len(calls) == 2:
+                raise prawcore.exceptions.PrawcoreException('reddit down')
+
+        reddit = MagicMock()
+        reddit.auth.scopes.return_value = ['submit', 'privatemessages',
+                'read', 'identity']
+        reddit.inbox.unread.return_value = items
+
+        with patch('praww.praw.Reddit', return_value=reddit), \
+                TempFile('db') as seenDB:
+            RedditBot(subreddits=['sub'], sleep=0, dbName=seenDB) \
+                    .withPMListener(MagicMock(side_effect=answer)) \
+                    .run(lambda: removeFile(RedditBot.LOCK_FILE))
+
+        # the failed thing is given again, the other one is seen
+        self.assertEqual(calls, [other, pm, pm])
+        reddit.inbox.mark_read.assert_called_once_with(items)
+
+    def test_Stream(self):
+        comment = MagicMock(spec=Comment)
+        comment.fullname = 't1_streamed'
+        comment.link_id = 't3_streamed'
+        comment.author = 'user'
+        threads = []
+
+        def answer(r, thing):
+            # praw is not thread-safe
+            threads.append(threading.current_thread())
+            bot.reply(thing, 'answer')
+        listener = MagicMock(side_effect=answer)
+
+        reddit = MagicMock()
+        reddit.auth.scopes.return_value = ['submit', 'privatemessages',
+                'read', 'identity']
+        reddit.subreddit.return_value.stream.comments.return_value = \
+                iter([comment, comment, None])
+
+        with patch('praww.praw.Reddit', return_value=reddit), \
+                TempFile('db') as seenDB:
+            bot = RedditBot(subreddits=['sub'], sleep=0, dbName=seenDB) \
+                    .withCommentListener(listener)
+            bot.STREAM_MIN_PAUSE = 0
+            bot.stream(lambda: removeFile(RedditBot.LOCK_FILE))
+
+        # the repeated comment is seen
+        listener.assert_called_once_with(reddit, comment)
+        self.assertEqual(threads, [threading.main_thread()])
+        self.assertEqual(bot.metrics.counter('fetched'), 2)
+        self.assertEqual(bot.metrics.counter('new'), 1)
+        self.assertEqual(bot.metrics.counter('replies_sent'), 1)
+        # queued reply is sent
+        reddit.post.assert_called_once_with('api/comment/',
+                data={'text': 'answer', 'thing_id': 't1_streamed'})
+        reddit.subreddit.return_value.stream.comments.assert_called_once_with(
+                pause_after=-1)
+
+    def test_StreamBusy(self):
+        def busy():
+            # a stream that never runs dry
+            for i in itertools.count():
+                comment = MagicMock(spec=Comment)
+                comment.fullname = 't1_busy' + str(i)
+                comment.link_id = 't3_busy'
+                comment.author = 'user'
+                yield comment
+
+        pm = MagicMock(spec=Message)
+        pm.fullname = 't4_pm'
+        pm.author = 'user'
+        commentListener = MagicMock(side_effect=lambda r, thing:
+                bot.reply(thing, 'answer'))
+        pmListener = MagicMock()
+        postRound = MagicMock(side_effect=lambda:
+                removeFile(RedditBot.LOCK_FILE))
+
+        reddit = MagicMock()
+        reddit.auth.scopes.return_value = ['submit', 'privatemessages',
+                'read', 'identity']
+        reddit.subreddit.return_value.stream.comments.return_value = busy()
+        reddit.inbox.stream.return_value = iter([pm, None])
+
+        with patch('praww.praw.Reddit', return_value=reddit), \
+                TempFile('db') as seenDB:
+            bot = RedditBot(subreddits=['sub'], sleep=0, dbName=seenDB) \
+                    .withCommentListener(commentListener) \
+                    .withPMListener(pmListener)
+            bot.STREAM_MIN_PAUSE = 0
+            bot.STREAM_BATCH = 5
+            bot.stream(postRound)
+
+        # inbox, outbox and post round are not starved
+        self.assertEqual(commentListener.call_count, 5)
+        pmListener.assert_called_once_with(reddit, pm)
+        reddit.inbox.mark_read.assert_called_once_with([pm])
+        self.assertEqual(bot.metrics.counter('replies_sent'), 5)
+        postRound.assert_called_once_with()
+
+    def test_StreamWritesPaused(self):
+        comment = MagicMock(spec=Comment)
+        comment.fullname = 't1_streamed'
+        comment.link_id = 't3_streamed'
+        comment.author = 'user'
+        listener = MagicMock(side_effect=lambda r, thing:
+                bot.reply(thing, 'answer'))
+
+        reddit = MagicMock()
+        reddit.auth.scopes.return_value = ['submit', 'privatemessages',
+                'read', 'identity']
+        reddit.subreddit.return_value.stream.comments.return_value = \
+                iter([comment, None])
+
+        with patch('praww.praw.Reddit', return_value=reddit), \
+                TempFile('db') as seenDB:
+            bot = RedditBot(subreddits=['sub'], sleep=0, dbName=seenDB) \
+                    .withCommentListener(listener)
+            bot.STREAM_MIN_PAUSE = 0
+            bot.limiter.pauseWrites(600)
+            start = time.monotonic()
+            bot.stream(lambda: removeFile(RedditBot.LOCK_FILE))
+
+        # the round does not wait for the pause, the reply stays queued
+        self.assertLess(time.monotonic() - start, 5)
+        listener.assert_called_once_with(reddit, comment)
+        reddit.post.assert_not_called()
+
+    def test_Outbox(self):
+        with TempFile('db') as dbFile:
+            outbox = _Outbox(dbFile)
+            self.assertTrue(outbox.put('t1_a', 'a'))
+            self.assertTrue(outbox.put('t1_b', 'b'))
+            self.assertFalse(outbox.put('t1_a', 'again'), 'one reply per thing')
+            outbox.close()
+
+            # survives restart
+            outbox = _Outbox(dbFile)
+            self.assertEqual(outbox.due(10), [('t1_a', 'a', 0), ('t1_b', 'b', 0)])
+
+            outbox.update(sent=['t1_a'], failed=[('t1_b', 0)])
+            self.assertEqual(outbox.due(10), [], 'b waits for retry')
+            self.assertFalse(outbox.put('t1_a', 'a'), 'already sent')
+
+            # postponed without an attempt
+            outbox.put('t1_c', 'c')
+            outbox.postpone(['t1_c'], 60)
+            self.assertEqual(outbox.due(10), [])
+
+            # give up after some attempts
+            outbox.update(failed=[('t1_b', _Outbox.MAX_ATTEMPTS - 1)])
+            self.assertTrue(outbox.put('t1_b', 'b'), 'dropped')
+            outbox.close()
+
     def test_seenDB(self):
         with TempFile('db') as dbfile:
             db = _SeenDB(dbfile)
@@ -360,6 +990,53 @@ class TestPRAWW(unittest.TestCase):
             self.assertTrue(db.isSeen(thing))
             db.close()
 
+    def test_seenDBRestart(self):
+        with TempFile('db') as dbfile:
+            class Thing():
+                def __init__(self, fullname):
+                    self.fullname = fullname
+
+            db = _SeenDB(dbfile, recentSize=2)
+            for i in range(5):
+                self.assertFalse(db.isSeen(Thing("t1_" + str(i))))
+            db.close()
+
+            # recent ids and bloom filter are loaded from the table
+            db = _SeenDB(dbfile, recentSize=2)
+            for i in range(5):
+                self.assertTrue(db.isSeen(Thing("t1_" + str(i))))
+            self.assertFalse(db.isSeen(Thing("t1_new")))
+            self.assertTrue(db.isSeen(Thing("t1_new")))
+            db.close()
+
+    def test_seenDBGrowing(self):
+        class Thing():
+            def __init__(self, fullname):
+                self.fullname = fullname
+
+        with TempFile('db') as dbfile:
+            db = _SeenDB(dbfile, bloomCapacity=2)
+            scans = []
+            db.conn.set_trace_callback(lambda sql:
+                    scans.append(sql) if sql.startswith('SELECT id, created') else None)
+
+            for i in range(64):
+                self.assertFalse(db.isSeen(Thing("t1_" + str(i))))
+                db.flush()
+            # the bloom filter grows, the table is not read every round
+            self.assertLess(len(scans), 8)
+            self.assertTrue(all(db.isSeen(Thing("t1_" + str(i))) for i in range(64)))
+            db.close()
+
+    def test_BloomFilter(self):
+        bloom = _BloomFilter(1000)
+        for i in range(1000):
+            bloom.add(str(i))
+        for i in range(1000):
+            self.assertTrue(str(i) in bloom)
+        falsePositives = sum(1 for i in range(1000, 11000) if str(i) in bloom)
+        self.assertLess(falsePositives, 100)
+
 
 class TestCardDB(unittest.TestCase):
     """cardDB.py"""
@@ -567,6 +1244,271 @@ class TestCardDB(unittest.TestCase):
 
             self.assertTrue('quickshot' in db)
             self.assertTrue('Quick Shot' in db['quickshot'])
+            self.assertEqual(db.generation, 1)
+
+            # a broken file changes nothing
+            with TempFile('json') as brokenJson:
+                with open(brokenJson, 'w') as f:
+                    f.write('{"Card A": {"name": "Card A"}, "Broken": ')
+                db.tempJSON = brokenJson
+                db.refreshTemp()
+
+            self.assertFalse('carda' in db)
+            self.assertEqual(db.cardNames(), ['quickshot'])
+            self.assertEqual(db.generation, 1)
+
+
+    def test_CardDBSnapshot(self):
+        cardDict = {
+            'Quick Shot': {
+                'type': 'Spell',
+                'hpwn': 14459,
+                'cdn': 'https://media-Hearth.cursecdn.com/14459.png',
+                'desc': 'Deal 3 damage. Draw a card.',
+                'hp': 1,
+                'class': 'Hunter',
+                'subType': "Mech",
+                'set': 'Basic',
+                'rarity': 'Common',
+                'atk': 3,
+                'head': 'quick-shot',
+                'name': 'Quick Shot',
+                'cost': 2
+            }
+        }
+
+        constantDict = {
+            'sets' : { '01' : {'name' : 'Basic'} },
+            'specials' : { },
+            'alternative_names' : { }
+        }
+
+        with TempJson(constantDict) as constJson, \
+                TempJson(cardDict) as cardJson, \
+                TempJson({}) as emptyJson, \
+                TempFile('snapshot') as snapshot:
+
+            c = Constants(constJson)
+            files = dict(cardJSON=cardJson, duelsJSON=emptyJson,
+                    vanillaJSON=emptyJson, tokenJSON=emptyJson,
+                    tempJSON=emptyJson, snapshotFile=snapshot)
+            CardDB(constants=c, **files).saveSnapshot()
+            self.assertTrue(os.path.isfile(snapshot))
+
+            # snapshot is used, json changes are not seen with the same mtime
+            stat = os.stat(cardJson)
+            with open(cardJson, 'r') as f:
+                text = f.read()
+            with open(cardJson, 'w', newline="\n") as f:
+                f.write(text.replace('Quick', 'Quack'))
+            os.utime(cardJson, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+            db = CardDB(constants=c, **files)
+            self.assertEqual(db.cardNames(), ['quickshot'])
+            self.assertTrue('Quick Shot' in db['quickshot'])
+
+            # stale snapshot falls back to json
+            with open(cardJson, 'w') as f:
+                json.dump({}, f)
+            db = CardDB(constants=c, **files)
+            self.assertEqual(db.cardNames(), [])
+
+
+    def test_RefreshCardFiles(self):
+        card = {
+            'type': 'Spell',
+            'hpwn': 14459,
+            'cdn': 'https://media-Hearth.cursecdn.com/14459.png',
+            'desc': 'Deal 3 damage. Draw a card.',
+            'hp': 1,
+            'class': 'Hunter',
+            'subType': "Mech",
+            'set': 'Basic',
+            'rarity': 'Common',
+            'atk': 3,
+            'head': 'quick-shot',
+            'name': 'Quick Shot',
+            'cost': 2
+        }
+        cardDict = {
+            'Quick Shot': card,
+            'Card A': dict(card, name='Card A')
+        }
+
+        constantDict = {
+            'sets' : { '01' : {'name' : 'Basic'} },
+            'specials' : { },
+            'alternative_names' : { }
+        }
+
+        def rewrite(path, obj):
+            with open(path, 'w', newline="\n") as f:
+                json.dump(obj, f)
+            # mtime resolution of some file systems is coarse
+            stat = os.stat(path)
+            os.utime(path, (stat.st_atime, stat.st_mtime + 10))
+
+        with TempJson(constantDict) as constJson, \
+                TempJson(cardDict) as cardJson, \
+                TempJson({}) as tokenJson, \
+                TempJson({}) as emptyJson, \
+                TempFile('snapshot') as snapshot:
+
+            c = Constants(constJson)
+            files = dict(cardJSON=cardJson, duelsJSON=emptyJson,
+                    vanillaJSON=emptyJson, tokenJSON=tokenJson,
+                    tempJSON='notexisting.json', snapshotFile=snapshot)
+            CardDB(constants=c, **files).saveSnapshot()
+            db = CardDB(constants=c, **files)
+            helper = HSHelper(db, c)
+
+            # nothing changed
+            db.refresh()
+            self.assertEqual(db.generation, 0)
+
+            # change, add and remove cards
+            rewrite(cardJson, {
+                'Quick Shot': dict(card, desc='Deal 4 damage.'),
+                'Card B': dict(card, name='Card B')
+            })
+            rewrite(tokenJson, {'Token X': dict(card, name='Token X')})
+            db.refresh()
+
+            self.assertEqual(sorted(db.cardNames()),
+                    ['cardb', 'quickshot', 'tokenx'])
+            self.assertTrue('Deal 4 damage.' in db['quickshot'])
+            self.assertFalse('carda' in db)
+            self.assertEqual(db.tokens, ['tokenx'])
+
+            # helper follows
+            cards, text = helper.parseText('[[Card B]] [[Card A]] [[Tokn X]]')
+            self.assertEqual(cards, ['cardb', 'tokenx'])
+            self.assertEqual(helper.spellChecker.correct('carda'), 'cardb')
+
+            # duplicates are rejected
+            generation = db.generation
+            rewrite(tokenJson, {'Card B': dict(card, name='Card B')})
+            db.refreshFiles()
+            self.assertEqual(db.generation, generation)
+            self.assertEqual(db.tokens, ['tokenx'])
+
+            # a card moved from tokens to cards stays
+            rewrite(cardJson, {
+                'Quick Shot': dict(card, desc='Deal 4 damage.'),
+                'Card B': dict(card, name='Card B'),
+                'Token X': dict(card, name='Token X')
+            })
+            rewrite(tokenJson, {})
+            db.refreshFiles()
+            self.assertTrue('tokenx' in db)
+            self.assertEqual(db.tokens, [])
+
+            # half written files are read again
+            with open(tokenJson, 'w') as f:
+                f.write('{"Token Y": ')
+            db.refreshFiles()
+            self.assertFalse('tokeny' in db)
+            rewrite(tokenJson, {'Token Y': dict(card, name='Token Y')})
+            db.refreshFiles()
+            self.assertTrue('tokeny' in db)
+            self.assertTrue('tokenx' in db)
+            self.assertEqual(db.tokens, ['tokeny'])
+
+    def test_RefreshVanillaFile(self):
+        card = {
+            'type': 'Spell',
+            'hpwn': 14459,
+            'cdn': 'https://media-Hearth.cursecdn.com/14459.png',
+            'desc': 'Deal 3 damage. Draw a card.',
+            'hp': None,
+            'class': 'Hunter',
+            'subType': None,
+            'set': 'Basic',
+            'rarity': 'Common',
+            'atk': None,
+            'head': 'quick-shot',
+            'name': 'Quick Shot',
+            'cost': 2
+        }
+        constantDict = {
+            'sets' : { '01' : {'name' : 'Basic'} },
+            'specials' : { },
+            'alternative_names' : { }
+        }
+
+        with TempJson(constantDict) as constJson, \
+                TempJson({'Quick Shot': card}) as cardJson, \
+                TempJson({}) as tokenJson, \
+                TempJson({}) as duelsJson, \
+                TempJson({'Quick Shot': dict(card, desc='Deal 2 damage.')}) as vanillaJson:
+
+            db = CardDB(constants=Constants(constJson), cardJSON=cardJson,
+                    duelsJSON=duelsJson, vanillaJSON=vanillaJson,
+                    tokenJSON=tokenJson, tempJSON='notexisting.json')
+            self.assertTrue('Deal 2 damage.' in db[CardDB.VANILLA_CMD + 'quickshot'])
+
+            # vanilla cards are reloaded with their prefix while running
+            with open(vanillaJson, 'w', newline="\n") as f:
+                json.dump({'Vanilla Only': dict(card, name='Vanilla Only',
+                        desc='Deal 1 damage.')}, f)
+            stat = os.stat(vanillaJson)
+            os.utime(vanillaJson, (stat.st_atime, stat.st_mtime + 10))
+            db.refreshFiles()
+
+            self.assertFalse(CardDB.VANILLA_CMD + 'quickshot' in db)
+            self.assertTrue('Deal 3 damage.' in db['quickshot'])
+            # found as fallback without prefix
+            self.assertTrue('Deal 1 damage.' in db['vanillaonly'])
+            self.assertEqual(sorted(db.cardNames()), ['quickshot', 'vanillaonly'])
+
+    def test_RefreshCardDBOnline(self):
+        cardDict = {
+            'Quick Shot': {
+                'type': 'Spell',
+                'hpwn': 14459,
+                'cdn': 'https://media-Hearth.cursecdn.com/14459.png',
+                'desc': 'Deal 3 damage. Draw a card.',
+                'hp': 1,
+                'class': 'Hunter',
+                'subType': "Mech",
+                'set': 'Basic',
+                'rarity': 'Common',
+                'atk': 3,
+                'head': 'quick-shot',
+                'name': 'Quick Shot',
+                'cost': 2
+            }
+        }
+
+        constantDict = {
+            'sets' : { '01' : {'name' : 'Basic'} },
+            'specials' : { },
+            'alternative_names' : { }
+        }
+
+        res = MagicMock()
+        res.status_code = 200
+        res.headers = {'etag': 'abc'}
+        res.json = MagicMock(return_value=cardDict)
+
+        with TempJson(constantDict) as constJson, \
+                TempJson({}) as emptyJson, \
+                patch('cardDB.requests.get', return_value=res) as get:
+
+            c = Constants(constJson)
+            db = CardDB(constants=c, cardJSON=emptyJson, duelsJSON=emptyJson, vanillaJSON=emptyJson, tokenJSON=emptyJson, tempJSON='notexisting.json',
+                    tempJSONUrl='https://localhost/temp.json', tempJSONTimeout=3)
+            db.waitForRefresh(5)
+
+            get.assert_called_once_with('https://localhost/temp.json',
+                    headers={}, timeout=3)
+            self.assertTrue('quickshot' in db)
+            self.assertEqual(db.generation, 1)
+            self.assertLess(db.lastRefreshAge(), 5)
+
+            # throttled
+            db.refreshTemp()
+            db.waitForRefresh(5)
+            self.assertEqual(get.call_count, 1)
 
 
 class TestHelper(unittest.TestCase):
@@ -669,6 +1611,69 @@ class TestHelper(unittest.TestCase):
             self.assertEqual(len(text), 0, 'card too long')
 
 
+    def test_parseTextCache(self):
+
+        cardDict = {
+            'Quick Shot': {
+                'type': 'Spell',
+                'hpwn': 14459,
+                'cdn': 'https://media-Hearth.cursecdn.com/14459.png',
+                'desc': 'Deal 3 damage. Draw a card.',
+                'hp': 1,
+                'class': 'Hunter',
+                'subType': "Mech",
+                'set': 'Basic',
+                'rarity': 'Common',
+                'atk': 3,
+                'head': 'quick-shot',
+                'name': 'Quick Shot',
+                'cost': 2
+            }
+        }
+
+        constantDict = {
+            'sets' : { '01' : {'name' : 'Basic'} },
+            'specials' : { },
+            'alternative_names' : { }
+        }
+
+        with TempJson(constantDict) as constJson, \
+                TempJson(cardDict) as cardJson, \
+                TempJson({}) as emptyJson:
+
+            c = Constants(constJson)
+            db = CardDB(constants=c, cardJSON=emptyJson, duelsJSON=emptyJson, vanillaJSON=emptyJson, tokenJSON=emptyJson, tempJSON='notexisting.json')
+            helper = HSHelper(db, c)
+
+            self.assertEqual(helper.parseText('[[Quick Shot]]'), ([], ''))
+            self.assertEqual(helper.parseText('[[Quick Shot]]'), ([], ''))
+            stats = helper.cacheStats()
+            self.assertEqual(stats['tokens'],
+                    {'hits': 1, 'misses': 1, 'size': 1})
+            self.assertEqual(stats['answers'],
+                    {'hits': 1, 'misses': 1, 'size': 1})
+
+            # refresh clears cached results
+            db.tempJSON = cardJson
+            db.refreshTemp()
+            cards, text = helper.parseText('[[Quick Shot]]')
+            self.assertEqual(cards, ['quickshot'])
+            self.assertTrue('Quick Shot' in text)
+            stats = helper.cacheStats()
+            self.assertEqual(stats['tokens']['size'], 1)
+            self.assertEqual(stats['answers']['misses'], 2)
+
+    def test_LRUCache(self):
+        cache = LRUCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'), 'least recently used is dropped')
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.stats(), {'hits': 3, 'misses': 1, 'size': 2})
+
     def test_loadInfoTempl_simple(self):
 
         constantDict = {
@@ -729,6 +1734,35 @@ class TestSpelling(unittest.TestCase):
         # only distance 1 errors are fixed
         self.assertEqual(checker.correct("abcd"), "abcd")
 
+    def test_SpellcheckerLongWords(self):
+        checker = SpellChecker(["ragnarosthefirelord", "ragnaros", "rag"])
+        self.assertEqual(checker.correct("ragnarosthefirelord"),
+                "ragnarosthefirelord")
+        # distance 2 errors in long words
+        self.assertEqual(checker.correct("ragnarosthefirlrod"),
+                "ragnarosthefirelord")
+        self.assertEqual(checker.correct("ragnrosthefirelor"),
+                "ragnarosthefirelord")
+        self.assertEqual(checker.correct("raganrso"), "ragnaros")
+        # closest word wins
+        self.assertEqual(checker.correct("ragnaro"), "ragnaros")
+        self.assertEqual(checker.correct("ragnarosthefire"),
+                "ragnarosthefire")
+
+
+    def test_SpellcheckerRanking(self):
+        checker = SpellChecker(["card", "cart"])
+        # d is next to x on the keyboard
+        self.assertEqual(checker.correct("carx"), "card")
+        # transposed keys before replaced keys
+        checker = SpellChecker(["abdc", "abcz"])
+        self.assertEqual(checker.correct("abcd"), "abdc")
+        # popular cards win ties
+        checker = SpellChecker(["carda", "cardb"])
+        self.assertEqual(checker.correct("cardp"), "carda")
+        checker = SpellChecker(["carda", "cardb"], {"cardb": 5, "x": 100})
+        self.assertEqual(checker.correct("cardp"), "cardb")
+
 
 class TestBot(unittest.TestCase):
     """hearthscan-bot.py"""
@@ -844,6 +1878,35 @@ class TestBot(unittest.TestCase):
 
         self.assertEqual(helper.method_calls, [], 'no helper calls')
 
+    def test_SendRoundAnswers(self):
+        answeredDB = commentDB.DB(':memory:')
+        answeredDB.addCards([('t1_c', 'card')])
+
+        def comment(parent_id, error=None):
+            comment = MagicMock()
+            comment.parent_id = parent_id
+            comment.reply.side_effect = error
+            return comment
+
+        failed = comment('t1_a', praw.exceptions.PRAWException('failed'))
+        first = comment('t1_b')
+        second = comment('t1_b')
+        answered = comment('t1_c')
+        roundAnswers = [(failed, ['card'], 'text a'),
+                (first, ['card'], 'text b'),
+                (second, ['card'], 'text b'),
+                (answered, ['card'], 'text c')]
+
+        hsbot.sendRoundAnswers(roundAnswers, answeredDB)
+
+        self.assertEqual(roundAnswers, [], 'round is done')
+        self.assertEqual(first.method_calls, [call.reply('text b')], 'after failed reply')
+        self.assertEqual(second.method_calls, [], 'duplicate of the same round')
+        self.assertEqual(answered.method_calls, [], 'duplicate')
+        # only sent replies count as posted
+        self.assertEqual(answeredDB.postedCards(['t1_a', 't1_b']), {('t1_b', 'card')})
+        answeredDB.close()
+
     def test_CleamPMUserCache(self):
         future = int(time.time()) + 60
         cache = {"aaa": 123, "bbb": future}